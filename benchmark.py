@@ -0,0 +1,410 @@
+"""
+Benchmark of all service routes against synthetic data, using an in-process ASGI client.
+
+    python benchmark.py --output results.json
+    python benchmark.py --output new.json --compare results.json
+    python benchmark.py --startup 10
+
+The database defaults to a separate benchmark.db, which is seeded once and reused by later runs.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import random
+import statistics
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the quota service routes")
+    parser.add_argument("--database", default="sqlite+aiosqlite:///./benchmark.db", help="DATABASE_URL to benchmark against")
+    parser.add_argument("--courses", type=int, default=10000, help="Number of synthetic courses")
+    parser.add_argument("--members", type=int, default=100, help="Number of course-user quotas per course")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per route")
+    parser.add_argument("--snapshot-requests", type=int, default=3,
+                        help="Requests of the snapshot routes, which export or import all quotas one at a time")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent requests per route")
+    parser.add_argument("--bulk-size", type=int, default=200, help="Number of quota items in bulk PUT payloads")
+    parser.add_argument("--routes", nargs="*", help="Only run routes whose name contains one of these strings")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="Measure the time to first request of this many service starts, routes are then only "
+                             "benchmarked if selected with --routes")
+    parser.add_argument("--reseed", action="store_true", help="Drop and seed the synthetic data again")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Compare the results with a previous JSON result file")
+    return parser.parse_args()
+
+
+async def seed_synthetic_data(db, courses: int, members: int, chunk_size: int = 10000):
+    from sqlalchemy import insert, select
+
+    import models
+    from schemas import QuotaScope
+
+    if await db.scalar(select(models.Quota.id).where(models.Quota.course_id == "bench-course-0").limit(1)):
+        return
+
+    quota_definitions = {(d.scope, d.feature): d for d in await db.scalars(select(models.QuotaDefinition))}
+    course_definition = quota_definitions[(QuotaScope.course, None)]
+    course_user_definition = quota_definitions[(QuotaScope.course_user, None)]
+
+    def rows():
+        for course in range(courses):
+            course_id = f"bench-course-{course}"
+            yield {
+                "limit": 10000, "used": 0, "type": course_definition.type, "scope": QuotaScope.course,
+                "course_id": course_id, "quota_definition_id": course_definition.id
+            }
+            yield {
+                "limit": 100, "used": None, "type": course_user_definition.type, "scope": QuotaScope.course_user,
+                "course_id": course_id, "quota_definition_id": course_user_definition.id
+            }
+            for member in range(members):
+                yield {
+                    "limit": 100, "used": 0, "type": course_user_definition.type, "scope": QuotaScope.course_user,
+                    "course_id": course_id, "user_id": f"bench-user-{member}", "quota_definition_id": course_user_definition.id
+                }
+
+    # Plain multi-row inserts in one transaction, the ORM unit of work is far too slow for millions of rows
+    chunk = []
+    for row in rows():
+        chunk.append({"feature": None, "user_id": None, **row})
+        if len(chunk) >= chunk_size:
+            await db.execute(insert(models.Quota.__table__), chunk)
+            chunk = []
+    if chunk:
+        await db.execute(insert(models.Quota.__table__), chunk)
+    await db.commit()
+
+
+def create_token(sub: str) -> str:
+    from jose import jwt
+
+    now = datetime.now(timezone.utc)
+    return jwt.encode({
+        "sub": sub,
+        "name": "Benchmark User",
+        "iat": now,
+        "exp": now + timedelta(seconds=30),
+        "context": "course-0",
+        "context-role": "learner"
+    }, os.getenv("SECRET_KEY"), algorithm="HS256")
+
+
+async def receive_quota_event(client, url: str, headers: dict, course_id: str, json: list) -> int:
+    """Subscribe to the quota events of a course, update its quotas and wait for the event."""
+    from main import app
+
+    # The ASGI transport of httpx buffers whole responses, so the endless event stream is driven directly
+    messages = asyncio.Queue()
+    disconnected = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": url, "raw_path": url.encode(), "query_string": f"course_id={course_id}".encode(), "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "server": ("benchmark", 80), "client": ("127.0.0.1", 0),
+    }
+    stream = asyncio.create_task(app(scope, receive, send=messages.put))
+    try:
+        status_code = (await messages.get())["status"]
+        if status_code == 200:
+            # Subscribed once the first comment arrived
+            await messages.get()
+            await client.put(f"/quota/course/{course_id}", headers=headers, json=json)
+            while b"event: quotas" not in (await messages.get()).get("body", b""):
+                pass
+        return status_code
+    finally:
+        disconnected.set()
+        await stream
+
+
+def scenarios(args, client) -> dict:
+    """
+    Functions building the request of each route, called with the request number.
+
+    Requests are (method, url, kwargs) tuples, or awaitables of them if they have to be prepared first,
+    e.g. with the validators of an earlier response. A callable method is awaited with the client, url and
+    kwargs instead of sending a single request.
+    """
+    headers = {"Authorization": f"Bearer {os.getenv('API_KEY')}"}
+    rng = random.Random(42)
+
+    def course_id():
+        return f"bench-course-{rng.randrange(args.courses)}"
+
+    def hot_course_id():
+        # Few courses, which clients poll again and again
+        return f"bench-course-{rng.randrange(min(args.courses, 10))}"
+
+    def member_id():
+        return f"bench-user-{rng.randrange(max(args.members, 1))}"
+
+    token = create_token("jdoe")
+    tokens = [create_token(f"user-{i}") for i in range(args.requests)]
+    global_payload = [
+        {"limit": 1000, "scope": "total"}, {"limit": 1000, "scope": "user"},
+        {"limit": 1000, "scope": "user", "feature": "gpt-3"}, {"limit": 1000, "scope": "course"}
+    ]
+    course_payload = [{"limit": 100, "scope": "course"}, {"limit": 10, "scope": "course-user"}]
+    validators = {}
+    snapshot = {}
+
+    async def conditional(url: str):
+        # Validators of the first response of the url, later requests are answered with 304
+        if url not in validators:
+            validators[url] = (await client_request("GET", url)).headers
+        return "GET", url, {"headers": {**headers, "If-None-Match": validators[url]["ETag"]}}
+
+    async def since(url: str):
+        # Revision of the first response of the url, later requests get the changes after it
+        if url not in validators:
+            validators[url] = (await client_request("GET", url)).headers
+        return "GET", url, {"headers": headers, "params": {"since": validators[url]["X-Quota-Revision"]}}
+
+    async def import_snapshot():
+        if "body" not in snapshot:
+            snapshot["body"] = (await client_request("GET", "/snapshot")).content
+        return "PUT", "/snapshot", {"headers": headers, "content": snapshot["body"]}
+
+    async def client_request(method: str, url: str):
+        response = await client.request(method, url, headers=headers)
+        response.raise_for_status()
+        return response
+
+    return {
+        "POST / (cached token)": lambda i: ("POST", "/", {"data": {"token": token}}),
+        "POST / (new token)": lambda i: ("POST", "/", {"data": {"token": tokens[i]}}),
+        "GET /metadata": lambda i: ("GET", "/metadata", {"headers": headers}),
+        "GET /quota": lambda i: ("GET", "/quota", {"headers": headers}),
+        "PUT /quota": lambda i: ("PUT", "/quota", {"headers": headers, "json": global_payload}),
+        "PUT /quota (bulk)": lambda i: ("PUT", "/quota", {
+            "headers": headers, "json": [global_payload[n % len(global_payload)] for n in range(args.bulk_size)]
+        }),
+        "POST /quota/consume": lambda i: ("POST", "/quota/consume", {"headers": headers, "json": {
+            "amount": 1, "type": "token", "user_id": member_id(), "course_id": course_id()
+        }}),
+        "GET /quota (If-None-Match)": lambda i: conditional("/quota"),
+        "GET /quota (since)": lambda i: since("/quota"),
+        "GET /quota/effective": lambda i: ("GET", "/quota/effective", {"headers": headers, "params": {
+            "user_id": member_id(), "course_id": course_id(), "feature": "gpt-3"
+        }}),
+        "GET /quota/events": lambda i: (receive_quota_event, "/quota/events", {
+            "headers": headers, "course_id": course_id(), "json": course_payload
+        }),
+        "GET /usage": lambda i: ("GET", "/usage", {"headers": headers, "params": {"course_id": course_id()}}),
+        "GET /snapshot": lambda i: ("GET", "/snapshot", {"headers": headers}),
+        "PUT /snapshot": lambda i: import_snapshot(),
+        "GET /quota/course/{course_id}": lambda i: ("GET", f"/quota/course/{course_id()}", {"headers": headers}),
+        "GET /quota/course/{course_id} (If-None-Match)": lambda i: conditional(f"/quota/course/{hot_course_id()}"),
+        "GET /quota/course/{course_id} (since)": lambda i: since(f"/quota/course/{hot_course_id()}"),
+        "PUT /quota/course/{course_id}": lambda i: ("PUT", f"/quota/course/{course_id()}", {
+            "headers": headers, "json": course_payload
+        }),
+        "PUT /quota/course/{course_id} (bulk)": lambda i: ("PUT", f"/quota/course/{course_id()}", {
+            "headers": headers, "json": [course_payload[n % len(course_payload)] for n in range(args.bulk_size)]
+        }),
+        "POST /quota/courses": lambda i: ("POST", "/quota/courses", {"headers": headers, "json": {
+            "course_ids": [course_id() for _ in range(100)], "user_ids": [member_id() for _ in range(5)]
+        }}),
+        "GET /quota/course/{course_id}/user": lambda i: ("GET", f"/quota/course/{course_id()}/user", {"headers": headers}),
+        "GET /quota/course/{course_id}/user/{user_id}": lambda i: (
+            "GET", f"/quota/course/{course_id()}/user/{member_id()}", {"headers": headers}
+        ),
+        "PUT /quota/course/{course_id}/user/{user_id}": lambda i: (
+            "PUT", f"/quota/course/{course_id()}/user/{member_id()}", {
+                "headers": headers, "json": [{"limit": 20, "scope": "course-user"}]
+            }
+        ),
+    }
+
+
+async def measure(client, build_request, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            request = build_request(i)
+            if inspect.isawaitable(request):
+                # Not measured
+                request = await request
+            method, url, kwargs = request
+            start = time.perf_counter()
+            if callable(method):
+                status_code = await method(client, url, **kwargs)
+            else:
+                status_code = (await client.request(method, url, **kwargs)).status_code
+            latencies.append(time.perf_counter() - start)
+            if status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": requests / elapsed,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": latencies[int(0.50 * (len(latencies) - 1))] * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_startup(args) -> dict:
+    """Time from spawning a uvicorn process until it answers its first request, over args.startup runs."""
+    import httpx
+
+    port = free_port()
+    headers = {"Authorization": f"Bearer {os.getenv('API_KEY')}"}
+    env = {**os.environ, "DATABASE_URL": args.database, "RESET_SCHEDULER": "false"}
+    durations = []
+    for _ in range(args.startup):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("The service exited during startup")
+                try:
+                    if httpx.get(f"http://127.0.0.1:{port}/quota", headers=headers).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            durations.append(time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+
+    return {
+        "runs": len(durations),
+        # The first start also prepares the database if it was not yet at the current schema version
+        "first_ms": durations[0] * 1000,
+        "p50_ms": statistics.median(durations) * 1000,
+        "max_ms": max(durations) * 1000,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results: dict, baseline: dict | None):
+    print(f"{'route':<48} {'rps':>10} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}  change")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline:
+            before = baseline[name]
+            change = (
+                f"rps {100 * (result['throughput_rps'] / before['throughput_rps'] - 1):+.1f}%  "
+                f"p99 {100 * (result['p99_ms'] / before['p99_ms'] - 1):+.1f}%"
+            )
+        print(f"{name:<48} {result['throughput_rps']:>10.1f} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} "
+              f"{result['errors']:>7}  {change}")
+
+
+async def run(args):
+    import httpx
+
+    import models
+    from database import SessionLocal, engine
+    from main import app
+
+    # The service configures DEBUG logging on import, which would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.reseed:
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.drop_all)
+
+    results = {}
+    async with app.router.lifespan_context(app):
+        start = time.perf_counter()
+        async with SessionLocal() as db:
+            await seed_synthetic_data(db, args.courses, args.members)
+        logging.warning(f"Seeded synthetic data in {time.perf_counter() - start:.1f}s")
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name, build_request in scenarios(args, client).items():
+                if args.routes and not any(route in name for route in args.routes):
+                    continue
+                if "/snapshot" in name:
+                    # Exports and imports of all quotas, one after the other
+                    results[name] = await measure(client, build_request, args.snapshot_requests, 1)
+                else:
+                    results[name] = await measure(client, build_request, args.requests, args.concurrency)
+    return results
+
+
+def main():
+    args = parse_args()
+    # Must be set before the service modules create the engine
+    os.environ["DATABASE_URL"] = args.database
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    startup = None
+    if args.startup:
+        startup = measure_startup(args)
+        print(f"time to first request over {startup['runs']} starts: first {startup['first_ms']:.0f} ms, "
+              f"p50 {startup['p50_ms']:.0f} ms, max {startup['max_ms']:.0f} ms")
+
+    results = {}
+    if not args.startup or args.routes:
+        results = asyncio.run(run(args))
+
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)["results"]
+        print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "revision": git_revision(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+                "startup": startup,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
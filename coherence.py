@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+from typing import Callable
+
+from sqlalchemy import event, func, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from database import SessionLocal, dialect_insert
+
+# Channels of process-local caches, published to after writes of the data they hold
+DEFINITIONS = "definitions"
+QUOTAS = "quotas"
+
+# Counter of the revision of quota rows on SQLite, see next_quota_revision
+QUOTA_REVISION = "quota_revision"
+
+
+async def increment_generation(db: AsyncSession, channel: str) -> int:
+    """
+    Increment the generation of the channel in the transaction of db and return it.
+
+    The row stays locked until the transaction ends, so generations become visible in increasing order.
+    """
+    stmt = dialect_insert(db, models.CacheGeneration).values(channel=channel, generation=1).on_conflict_do_update(
+        index_elements=[models.CacheGeneration.channel],
+        set_={"generation": models.CacheGeneration.generation + 1}
+    ).returning(models.CacheGeneration.generation)
+    return await db.scalar(stmt)
+
+
+async def next_quota_revision(db: AsyncSession):
+    """
+    SQL expression of the revision to stamp the quota rows changed in the transaction of db with.
+
+    On PostgreSQL it is the id of the transaction, which writers get without a shared lock. Transactions
+    may commit in another order than they started, readers only trust revisions below the oldest running
+    transaction, see crud.get_quota_revision. SQLite serializes writers anyway, there the QUOTA_REVISION
+    counter is incremented.
+    """
+    if db.bind.dialect.name == "postgresql":
+        return func.txid_current()
+    return literal(await increment_generation(db, QUOTA_REVISION))
+
+
+class LocalBackend:
+    """Single process deployments, where the local subscribers are all there is to notify."""
+
+    async def publish(self, db: AsyncSession, channel: str):
+        pass
+
+    async def generations(self) -> dict[str, int]:
+        return {}
+
+
+class DatabaseBackend:
+    """
+    Generation counter per channel in the cache_generation table.
+
+    Writers increment it in the transaction of their change, so other workers cannot see the change
+    without the new generation. Polling reads a handful of rows by primary key.
+    """
+
+    async def publish(self, db: AsyncSession, channel: str):
+        await increment_generation(db, channel)
+
+    async def generations(self) -> dict[str, int]:
+        async with SessionLocal() as db:
+            result = await db.execute(select(models.CacheGeneration.channel, models.CacheGeneration.generation))
+            return dict(result.all())
+
+
+BACKENDS = {
+    "local": LocalBackend,
+    "database": DatabaseBackend,
+}
+
+
+class Coherence:
+    """
+    Keeps process-local caches coherent across worker processes.
+
+    Caches subscribe to a channel with a callback that drops their content. Writes publish to the
+    channel through the backend before they commit, the local subscribers are notified once the commit
+    succeeded. The other workers poll the backend every poll_interval seconds and notify their
+    subscribers of every channel whose generation changed, so their caches are stale for at most
+    poll_interval. Caches that the writers of their worker update themselves subscribe with local=False
+    and are only notified by polling.
+    """
+
+    def __init__(self, backend, poll_interval: float):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.subscribers: dict[str, list[tuple[Callable[[], None], bool]]] = {}
+        self.generations: dict[str, int] = {}
+        self._stopping = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, channel: str, callback: Callable[[], None], local: bool = True):
+        self.subscribers.setdefault(channel, []).append((callback, local))
+
+    def notify(self, channel: str, local: bool = True):
+        for callback, notify_local in self.subscribers.get(channel, []):
+            if notify_local or not local:
+                callback()
+
+    async def publish(self, db: AsyncSession, channel: str):
+        await self.backend.publish(db, channel)
+        event.listen(db.sync_session, "after_commit", lambda session: self.notify(channel), once=True)
+
+    async def poll(self, notify: bool = True):
+        generations = await self.backend.generations()
+        for channel, generation in generations.items():
+            # Also after own writes, notifying a subscriber twice only costs a reload
+            if notify and self.generations.get(channel, 0) != generation:
+                self.notify(channel, local=False)
+        self.generations.update(generations)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.poll()
+            except Exception as e:
+                logging.error(f"Polling cache generations failed: {e}")
+
+    async def start(self):
+        # The first poll only records the generations the caches are loaded at
+        await self.poll(notify=False)
+        if not isinstance(self.backend, LocalBackend) and self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Not cancelled, a poll in progress has to return its connection to the pool
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+
+coherence = Coherence(
+    backend=BACKENDS[os.getenv("COHERENCE_BACKEND", "local")](),
+    poll_interval=float(os.getenv("COHERENCE_POLL_INTERVAL", "0.5"))
+)
@@ -1,7 +1,20 @@
+import base64
+import json
+import math
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import String, and_, func, literal, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
 import models
 import schemas
+from coherence import QUOTAS, coherence, next_quota_revision
+from database import dialect_insert
+from quota_cache import quota_cache
+from rate_limit import rate_limiter
+from registry import definitions
+from reset import add_usage, period_case, quota_period
+from usage_buffer import usage_buffer
+from usage_events import as_utc, usage_events
 
 GLOBAL_SCOPES = [
     schemas.QuotaScope.user,
@@ -16,123 +29,253 @@ COURSE_SCOPES = [
 
 
 # CRUD für QuotaDefinition
-def get_quota_definitions(db: Session) -> list[models.QuotaDefinition]:
-    return db.query(models.QuotaDefinition).all()
+async def get_quota_definitions(db: AsyncSession) -> list[models.QuotaDefinition]:
+    return list((await definitions.get_all(db)).values())
 
 
 # CRUD für Quota
-def get_global_quotas(db: Session) -> list[models.Quota]:
-    return db.query(models.Quota).filter(
-        models.Quota.scope.in_(GLOBAL_SCOPES),
-        models.Quota.user_id == None,
-        models.Quota.course_id == None
-    ).all()
+def listed_quotas_filter(course_id: str = None) -> tuple:
+    # Rows of the global (course_id None) or course quota listing, without counters and course members
+    if course_id is None:
+        return models.Quota.scope.in_(GLOBAL_SCOPES), models.Quota.course_id == None, models.Quota.user_id == None
+    return models.Quota.scope.in_(COURSE_SCOPES), models.Quota.course_id == course_id, models.Quota.user_id == None
 
 
-def check_quota_definition(db: Session, quota: schemas.QuotaUpdate) -> models.QuotaDefinition:
-    quota_definition = db.query(models.QuotaDefinition).filter(
-        models.QuotaDefinition.scope == quota.scope,
-        models.QuotaDefinition.feature == quota.feature
-    ).first()
+async def get_global_quotas(db: AsyncSession, since: int = None) -> list[models.Quota]:
+    query = select(models.Quota).where(*listed_quotas_filter())
+    if since is not None:
+        query = query.where(models.Quota.revision > since)
+    # In order of creation, like the rowid order of the former unordered query on SQLite
+    result = await db.scalars(query.order_by(models.Quota.id))
+    return result.all()
 
-    if not quota_definition:
-        raise HTTPException(
-            status_code=404,
-            detail=f"QuotaDefinition with scope={quota.scope} and feature={quota.feature} not found"
-        )
 
-    return quota_definition
-
-
-def update_or_create_global_quota(db: Session, global_quota: schemas.QuotaUpdate) -> models.Quota:
-    if global_quota.scope not in GLOBAL_SCOPES:
-        raise HTTPException(status_code=400, detail="Supported global scopes: " + ', '.join([s.value for s in GLOBAL_SCOPES]))
-
-    # Check if the quota definition exists
-    quota_definition = check_quota_definition(db, global_quota)
-
-    db_quota = db.query(models.Quota).filter(
-        models.Quota.scope == global_quota.scope,
-        models.Quota.feature == global_quota.feature,
-        models.Quota.user_id == None,
-        models.Quota.course_id == None
-    ).first()
-
-    if db_quota:
-        # Update
-        db_quota.limit = global_quota.limit
-    else:
-        # Create
-        db_quota = models.Quota(
-            limit=global_quota.limit,
-            scope=global_quota.scope,
-            feature=global_quota.feature,
-            type=quota_definition.type,  # TODO: Do we need to store the type in each quota
-            quota_definition_id=quota_definition.id  # use the ID of the quota definition
-        )
-        db.add(db_quota)
+async def get_quota_revision(db: AsyncSession, course_id: str = None) -> tuple[int, str]:
+    # Revision up to which the listing of the course, or the global one, is complete and a version of its
+    # rows. Reads aggregates of the revision index, counters and member quotas leave both as they are.
+    columns = [func.max(models.Quota.revision), func.count(), func.sum(models.Quota.revision)]
+    if db.bind.dialect.name == "postgresql":
+        # Transactions from the oldest running one on may still commit rows of lower revisions
+        columns.append(func.txid_snapshot_xmin(func.txid_current_snapshot()) - 1)
+    result = (await db.execute(select(*columns).where(*listed_quotas_filter(course_id)))).one()
+    latest, count, total = result[0] or 0, result[1], result[2] or 0
+    revision = min(latest, result[3]) if len(result) > 3 else latest
+    return revision, listing_version(latest, count, total)
 
-    db.commit()
-    db.refresh(db_quota)
-    return db_quota
 
+def listing_version(latest: int, count: int, total: int) -> str:
+    # Every change gives a row a revision it did not have, which changes the sum
+    return f"{latest}:{count}:{total}"
 
-def get_course_quotas(db: Session, course_id: str) -> list[models.Quota]:
-    return db.query(models.Quota).filter(
-        models.Quota.scope.in_(COURSE_SCOPES),
-        models.Quota.course_id == course_id,
-        models.Quota.user_id == None
-    ).all()
 
+# Quotas of a listing with the revision up to which it is complete, see get_quota_revision
+class QuotaListing(list):
 
-def update_or_create_course_quota(db: Session, course_id: str, course_quota: schemas.QuotaUpdate) -> models.Quota:
-    if course_quota.scope not in COURSE_SCOPES:
-        raise HTTPException(status_code=400, detail="Supported course scopes: " + ', '.join([s.value for s in COURSE_SCOPES]))
+    revision = 0
 
-    # Check if the quota definition exists
-    quota_definition = check_quota_definition(db, course_quota)
+    @property
+    def version(self) -> str:
+        revisions = [quota.revision for quota in self]
+        return listing_version(max(revisions, default=0), len(revisions), sum(revisions))
 
-    db_quota = db.query(models.Quota).filter(
-        models.Quota.scope == course_quota.scope,
-        models.Quota.feature == course_quota.feature,
-        models.Quota.course_id == course_id,
-        models.Quota.user_id == None
-    ).first()
-
-    if db_quota:
-        # Update
-        db_quota.limit = course_quota.limit
-    else:
-        # Create
-        db_quota = models.Quota(
-            limit=course_quota.limit,
-            scope=course_quota.scope,
-            feature=course_quota.feature,
-            course_id=course_id,
-            type=quota_definition.type,  # TODO: Do we need to store the type in each quota
-            quota_definition_id=quota_definition.id  # use the ID of the quota definition
+
+async def check_quota_definitions(db: AsyncSession, quotas: list[schemas.QuotaUpdate]) -> dict:
+    quota_definitions = await definitions.get_all(db)
+
+    for quota in quotas:
+        if (quota.scope, quota.feature) not in quota_definitions:
+            raise HTTPException(
+                status_code=404,
+                detail=f"QuotaDefinition with scope={quota.scope} and feature={quota.feature} not found"
+            )
+
+    return quota_definitions
+
+
+def quota_insert(db: AsyncSession):
+    return dialect_insert(db, models.Quota)
+
+
+async def load_effective_limits(db: AsyncSession, quotas: list[models.Quota]):
+    # Quotas returned by INSERT or UPDATE ... RETURNING lack the effective limit, inherited ones are read with one query
+    inheriting = []
+    for quota in quotas:
+        if quota.limit is not None:
+            set_committed_value(quota, "effective_limit", quota.limit)
+        else:
+            inheriting.append(quota)
+    if inheriting:
+        result = await db.execute(
+            select(models.Quota.id, models.Quota.effective_limit).where(models.Quota.id.in_([q.id for q in inheriting]))
         )
-        db.add(db_quota)
+        limits = dict(result.all())
+        for quota in inheriting:
+            set_committed_value(quota, "effective_limit", limits.get(quota.id))
+
+
+async def bulk_upsert_quotas(db: AsyncSession, quotas: list[schemas.QuotaUpdate], existing_quotas: list[models.Quota],
+                             course_id: str = None, user_id: str = None) -> list[models.Quota]:
+    # Write the quotas with one upsert, existing_quotas must hold all stored quotas of the written key space
+    if not quotas:
+        return existing_quotas
+
+    quota_definitions = await check_quota_definitions(db, quotas)
+    quotas_by_key = {(q.scope, q.feature): q for q in existing_quotas}
+
+    revision = await next_quota_revision(db)
+
+    # Later entries for the same key win, like the former item by item updates
+    rows = {}
+    for quota in quotas:
+        quota_definition = quota_definitions[(quota.scope, quota.feature)]
+        rows[(quota.scope, quota.feature)] = {
+            "limit": quota.limit,
+            "scope": quota.scope,
+            "feature": quota.feature,
+            "course_id": course_id,
+            "user_id": user_id,
+            "type": quota_definition.type,  # TODO: Do we need to store the type in each quota
+            "quota_definition_id": quota_definition.id,  # use the ID of the quota definition
+        }
+
+    stmt = quota_insert(db).values(revision=revision)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=models.QUOTA_KEY,
+        set_={"limit": stmt.excluded.limit, "revision": stmt.excluded.revision}
+    ).returning(models.Quota).execution_options(populate_existing=True)
+
+    result = await db.scalars(stmt, list(rows.values()))
+    for db_quota in result:
+        quotas_by_key[(db_quota.scope, db_quota.feature)] = db_quota
+    await load_effective_limits(db, [quotas_by_key[key] for key in rows])
+
+    await coherence.publish(db, QUOTAS)
+    await db.commit()
+    quota_cache.invalidate([quotas_by_key[key] for key in rows], limits=True)
+    return sorted(quotas_by_key.values(), key=lambda q: q.id)
+
+
+async def update_or_create_global_quotas(db: AsyncSession, global_quotas: list[schemas.QuotaUpdate]) -> list[models.Quota]:
+    for global_quota in global_quotas:
+        if global_quota.scope not in GLOBAL_SCOPES:
+            raise HTTPException(status_code=400, detail="Supported global scopes: " + ', '.join([s.value for s in GLOBAL_SCOPES]))
+
+    return await bulk_upsert_quotas(db, global_quotas, await get_global_quotas(db))
+
+
+async def load_course_quotas(db: AsyncSession, course_id: str, since: int = None) -> list[models.Quota]:
+    query = select(models.Quota).where(*listed_quotas_filter(course_id))
+    if since is not None:
+        query = query.where(models.Quota.revision > since)
+    result = await db.scalars(query.order_by(models.Quota.id))
+    return result.all()
+
+
+async def load_course_listing(db: AsyncSession, course_id: str) -> QuotaListing:
+    # Read before the quotas, a concurrent write then only makes the next delta repeat a row
+    revision, _ = await get_quota_revision(db, course_id)
+    listing = QuotaListing(await load_course_quotas(db, course_id))
+    listing.revision = revision
+    return listing
 
-    db.commit()
-    db.refresh(db_quota)
-    return db_quota
 
+async def get_course_quotas(db: AsyncSession, course_id: str, since: int = None) -> list[models.Quota]:
+    # Changes since a revision are not cached
+    if since is not None:
+        return await load_course_quotas(db, course_id, since)
+    return await quota_cache.get_or_load(("course", course_id), lambda: load_course_listing(db, course_id))
 
-def get_course_member_quotas(db: Session, course_id: str) -> list[models.Quota]:
-    return db.query(models.Quota).filter(
+
+async def update_or_create_course_quotas(db: AsyncSession, course_id: str, course_quotas: list[schemas.QuotaUpdate]) -> list[models.Quota]:
+    for course_quota in course_quotas:
+        if course_quota.scope not in COURSE_SCOPES:
+            raise HTTPException(status_code=400, detail="Supported course scopes: " + ', '.join([s.value for s in COURSE_SCOPES]))
+
+    return await bulk_upsert_quotas(db, course_quotas, await load_course_quotas(db, course_id), course_id)
+
+
+def course_member_quotas_query(course_id: str):
+    # Ordered by (user_id, id), which follows the lookup index and gives a stable keyset
+    return select(models.Quota).where(
         models.Quota.scope == schemas.QuotaScope.course_user,
         models.Quota.course_id == course_id,
         models.Quota.user_id != None
-    ).all()
+    ).order_by(models.Quota.user_id, models.Quota.id)
 
 
-def get_course_member_quota(db: Session, course_id: str, user_id: str) -> models.Quota:
-    quota = db.query(models.Quota).filter(
-        models.Quota.scope == schemas.QuotaScope.course_user,
-        models.Quota.course_id == course_id,
-        models.Quota.user_id == user_id
-    ).first()
+def make_cursor(quota: models.Quota) -> str:
+    return base64.urlsafe_b64encode(json.dumps([quota.user_id, quota.id]).encode()).decode()
+
+
+def parse_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        user_id, quota_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(user_id), int(quota_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_course_member_quotas(db: AsyncSession, course_id: str, limit: int = None, after: str = None) -> list[models.Quota]:
+    return await quota_cache.get_or_load(
+        ("members", course_id, limit, after), lambda: load_course_member_quotas(db, course_id, limit, after)
+    )
+
+
+async def load_course_member_quotas(db: AsyncSession, course_id: str, limit: int = None, after: str = None) -> list[models.Quota]:
+    query = course_member_quotas_query(course_id)
+    if after:
+        user_id, quota_id = parse_cursor(after)
+        query = query.where(or_(
+            models.Quota.user_id > user_id,
+            and_(models.Quota.user_id == user_id, models.Quota.id > quota_id)
+        ))
+    if limit:
+        query = query.limit(limit)
+
+    result = await db.scalars(query)
+    return result.all()
+
+
+async def stream_course_member_quotas(db: AsyncSession, course_id: str, batch_size: int = 1000):
+    # Rows are fetched from a server-side cursor in batches instead of being materialized at once
+    result = await db.stream_scalars(course_member_quotas_query(course_id).execution_options(yield_per=batch_size))
+    async for quota in result:
+        yield quota
+
+
+def inherited_member_quota(default_quota: models.Quota, course_id: str, user_id: str) -> models.Quota:
+    # Unsaved quota of a member without own quota, with the limit of the course or global default
+    return models.Quota(
+        effective_limit=default_quota.effective_limit,
+        used=0,
+        period=quota_period(default_quota.quota_definition_id),
+        type=default_quota.type,
+        scope=default_quota.scope,
+        feature=default_quota.feature,
+        user_id=user_id,
+        course_id=course_id,
+        quota_definition_id=default_quota.quota_definition_id
+    )
+
+
+async def get_course_member_quota(db: AsyncSession, course_id: str, user_id: str) -> models.Quota:
+    return await quota_cache.get_or_load(
+        ("member", course_id, user_id), lambda: load_course_member_quota(db, course_id, user_id)
+    )
+
+
+async def load_course_member_quota(db: AsyncSession, course_id: str, user_id: str) -> models.Quota:
+    # Stored quota of the member, or the inherited course or global default as unsaved quota without usage
+    quota_definition = (await definitions.get_all(db)).get((schemas.QuotaScope.course_user, None))
+    quota = None
+    if quota_definition:
+        keys = consumption_keys(quota_definition.scope, schemas.QuotaSubject(user_id=user_id, course_id=course_id))
+        quota = await db.scalar(
+            select(models.Quota)
+            .where(or_(*[quota_key_filter(quota_definition, *key) for key in keys]))
+            .order_by(models.Quota.user_id.is_(None), models.Quota.course_id.is_(None))
+            .limit(1)
+        )
 
     if not quota:
         raise HTTPException(
@@ -140,4 +283,318 @@ def get_course_member_quota(db: Session, course_id: str, user_id: str) -> models
             detail=f"User quota with scope=course-user not found"
         )
 
+    if quota.user_id is None:
+        quota = inherited_member_quota(quota, course_id, user_id)
+
     return quota
+
+
+async def update_or_create_course_member_quotas(db: AsyncSession, course_id: str, user_id: str,
+                                                member_quotas: list[schemas.QuotaUpdate]) -> list[models.Quota]:
+    # Explicit override of the inherited limit, the usage of an existing quota is kept
+    for member_quota in member_quotas:
+        if member_quota.scope != schemas.QuotaScope.course_user:
+            raise HTTPException(status_code=400, detail="Supported course member scopes: " + schemas.QuotaScope.course_user.value)
+
+    result = await db.scalars(select(models.Quota).where(
+        models.Quota.scope == schemas.QuotaScope.course_user,
+        models.Quota.course_id == course_id,
+        models.Quota.user_id == user_id
+    ))
+    return await bulk_upsert_quotas(db, member_quotas, result.all(), course_id, user_id)
+
+
+async def get_courses_quotas(db: AsyncSession, course_ids: list[str], user_ids: list[str] = None) -> dict[str, list[models.Quota]]:
+    # Course quotas of several courses and the course-user quotas of the given members with one IN query
+    course_ids = list(dict.fromkeys(course_ids))
+    user_ids = list(dict.fromkeys(user_ids or []))
+
+    conditions = [and_(models.Quota.scope.in_(COURSE_SCOPES), models.Quota.user_id == None)]
+    if user_ids:
+        conditions.append(and_(models.Quota.scope == schemas.QuotaScope.course_user, models.Quota.user_id.in_(user_ids)))
+    query_filter = and_(models.Quota.course_id.in_(course_ids), or_(*conditions))
+    if user_ids:
+        # Global course-user default, inherited by members of courses without own default
+        query_filter = or_(query_filter, and_(
+            models.Quota.scope == schemas.QuotaScope.course_user, models.Quota.feature == None,
+            models.Quota.course_id == None, models.Quota.user_id == None
+        ))
+    result = await db.scalars(select(models.Quota).where(query_filter).order_by(models.Quota.id))
+
+    courses_quotas = {course_id: [] for course_id in course_ids}
+    member_quotas = {}
+    global_default = None
+    for quota in result:
+        if quota.course_id is None:
+            global_default = quota
+        elif quota.user_id is None:
+            courses_quotas[quota.course_id].append(quota)
+        else:
+            member_quotas.setdefault((quota.course_id, quota.user_id), []).append(quota)
+
+    for course_id in course_ids:
+        course_default = next((q for q in courses_quotas[course_id]
+                               if q.scope == schemas.QuotaScope.course_user and q.feature is None), global_default)
+        for user_id in user_ids:
+            if (course_id, user_id) in member_quotas:
+                courses_quotas[course_id] += member_quotas[(course_id, user_id)]
+            elif course_default is not None:
+                courses_quotas[course_id].append(inherited_member_quota(course_default, course_id, user_id))
+    return courses_quotas
+
+
+def applicable_quota_definitions(quota_definitions: dict, subject: schemas.QuotaSubject) -> list[models.QuotaDefinition]:
+    # Per scope, a definition for the requested feature takes precedence over the feature-less one
+    scopes = [schemas.QuotaScope.total, schemas.QuotaScope.user]
+    if subject.course_id is not None:
+        scopes += COURSE_SCOPES
+
+    applicable = []
+    for scope in scopes:
+        quota_definition = quota_definitions.get((scope, subject.feature)) or quota_definitions.get((scope, None))
+        if quota_definition and subject.type in (None, quota_definition.type):
+            applicable.append(quota_definition)
+    return applicable
+
+
+def consumption_keys(scope: schemas.QuotaScope, subject: schemas.QuotaSubject) -> list[tuple]:
+    # (course_id, user_id) of the row counting the consumption, then of the rows it inherits its limit from
+    course_id, user_id = subject.course_id, subject.user_id
+    if scope == schemas.QuotaScope.user:
+        return [(None, user_id), (None, None)]
+    if scope == schemas.QuotaScope.course:
+        return [(course_id, None), (None, None)]
+    if scope == schemas.QuotaScope.course_user:
+        return [(course_id, user_id), (course_id, None), (None, None)]
+    return [(None, None)]
+
+
+def quota_key_filter(quota_definition: models.QuotaDefinition, course_id: str | None, user_id: str | None):
+    return and_(
+        models.Quota.scope == quota_definition.scope,
+        models.Quota.feature == quota_definition.feature if quota_definition.feature else models.Quota.feature == None,
+        models.Quota.course_id == course_id if course_id else models.Quota.course_id == None,
+        models.Quota.user_id == user_id if user_id else models.Quota.user_id == None
+    )
+
+
+async def create_consumption_counter(db: AsyncSession, quota_definition: models.QuotaDefinition, keys: list[tuple],
+                                     used: int, revision) -> list[models.Quota]:
+    # Create the counter without own limit if a quota it inherits the limit from exists, the limit stays
+    # the one of that quota. A counter created concurrently by another request is incremented instead.
+    course_id, user_id = keys[0]
+    inherited = select(
+        literal(used), literal(quota_period(quota_definition.id), String), models.Quota.type,
+        models.Quota.scope, models.Quota.feature, literal(user_id, String), literal(course_id, String),
+        models.Quota.quota_definition_id, revision
+    ).where(
+        or_(*[quota_key_filter(quota_definition, *key) for key in keys[1:]])
+    ).order_by(models.Quota.course_id.is_(None)).limit(1)
+
+    stmt = quota_insert(db).from_select(
+        ["used", "period", "type", "scope", "feature", "user_id", "course_id", "quota_definition_id", "revision"],
+        inherited
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=models.QUOTA_KEY,
+        set_={
+            "used": add_usage(models.Quota.used, models.Quota.period, stmt.excluded.period, stmt.excluded.used),
+            "period": stmt.excluded.period,
+            "revision": stmt.excluded.revision
+        }
+    ).returning(models.Quota).execution_options(populate_existing=True)
+
+    result = await db.scalars(stmt)
+    return list(result)
+
+
+def is_exceeded(quota: models.Quota, used: int) -> bool:
+    # Counters whose inherited quota was removed have no limit
+    return quota.effective_limit is not None and used > quota.effective_limit
+
+
+def raise_quota_exceeded(scopes: list[schemas.QuotaScope]):
+    raise HTTPException(status_code=429, detail="Quota exceeded for scope: " + ', '.join([s.value for s in scopes]))
+
+
+def rate_limit_key(quota_definition: models.QuotaDefinition, course_id: str | None, user_id: str | None) -> tuple:
+    return quota_definition.scope, quota_definition.feature, course_id, user_id
+
+
+def is_consumption_counter(quota: models.Quota) -> bool:
+    # Whether the quota counts consumption itself instead of only providing an inherited limit
+    if quota.scope == schemas.QuotaScope.user:
+        return quota.user_id is not None
+    if quota.scope == schemas.QuotaScope.course:
+        return quota.course_id is not None and quota.user_id is None
+    if quota.scope == schemas.QuotaScope.course_user:
+        return quota.course_id is not None and quota.user_id is not None
+    return True
+
+
+def raise_rate_limited(denied: list[tuple[models.QuotaDefinition, float]]):
+    retry_after = max(seconds for _, seconds in denied)
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after != math.inf else None
+    raise HTTPException(
+        status_code=429,
+        detail="Rate limit exceeded for scope: " + ', '.join([d.scope.value for d, _ in denied]),
+        headers=headers
+    )
+
+
+async def consume_quota(db: AsyncSession, consumption: schemas.QuotaConsume) -> list[models.Quota]:
+    # All applicable quotas or none, rate limits are checked in memory first and given back on failure
+    quota_definitions = applicable_quota_definitions(await definitions.get_all(db), consumption)
+    keys = {d.scope: consumption_keys(d.scope, consumption) for d in quota_definitions}
+    if not quota_definitions:
+        # Nothing to count, but the log still records every consumption
+        usage_events.add(consumption)
+        return []
+    types = sorted({d.type for d in quota_definitions if d.type is not None})
+    if consumption.type is None and len(types) > 1:
+        # The amount would be counted in every unit, e.g. tokens as number of requests
+        raise HTTPException(
+            status_code=422,
+            detail="Quotas of the types " + ', '.join(types) + " apply, the type of the consumption is required"
+        )
+
+    limited = [
+        (d, rate_limit_key(d, *keys[d.scope][0])) for d in quota_definitions if d.burst_limit is not None
+    ]
+    denied = rate_limiter.acquire(limited, consumption.amount)
+    if denied:
+        raise_rate_limited(denied)
+
+    try:
+        if usage_buffer.enabled:
+            consumed_quotas = await consume_quota_buffered(db, consumption, quota_definitions, keys)
+        else:
+            consumed_quotas = await consume_quota_direct(db, consumption, quota_definitions, keys)
+    except Exception:
+        rate_limiter.release(limited, consumption.amount)
+        raise
+
+    usage_events.add(consumption)
+    return consumed_quotas
+
+
+async def consume_quota_direct(db: AsyncSession, consumption: schemas.QuotaConsume,
+                               quota_definitions: list[models.QuotaDefinition], keys: dict) -> list[models.Quota]:
+    # Increment inside the UPDATE and check the limits against the returned values, so concurrent
+    # consumptions never overwrite each other. Missing counters are created, any exceeded limit rolls back.
+    revision = await next_quota_revision(db)
+    # Counters of an ended reset period start over
+    period = period_case([d.id for d in quota_definitions])
+    result = await db.scalars(
+        update(models.Quota)
+        .where(or_(*[quota_key_filter(d, *keys[d.scope][0]) for d in quota_definitions]))
+        .values(used=add_usage(models.Quota.used, models.Quota.period, period, consumption.amount), period=period,
+                revision=revision)
+        .returning(models.Quota)
+        .execution_options(populate_existing=True)
+    )
+    consumed_quotas = list(result)
+
+    counted_scopes = {q.scope for q in consumed_quotas}
+    for quota_definition in quota_definitions:
+        if quota_definition.scope not in counted_scopes and len(keys[quota_definition.scope]) > 1:
+            consumed_quotas += await create_consumption_counter(
+                db, quota_definition, keys[quota_definition.scope], consumption.amount, revision
+            )
+
+    await load_effective_limits(db, consumed_quotas)
+    exceeded = [q.scope for q in consumed_quotas if is_exceeded(q, q.used)]
+    if exceeded:
+        await db.rollback()
+        raise_quota_exceeded(exceeded)
+
+    await db.commit()
+    quota_cache.invalidate(consumed_quotas)
+    return consumed_quotas
+
+
+async def consume_quota_buffered(db: AsyncSession, consumption: schemas.QuotaConsume,
+                                 quota_definitions: list[models.QuotaDefinition], keys: dict) -> list[models.Quota]:
+    # Check the limits against persisted plus pending usage, only missing counters are written directly
+    flushes = usage_buffer.flushes
+    result = await db.scalars(
+        select(models.Quota).where(or_(*[quota_key_filter(d, *keys[d.scope][0]) for d in quota_definitions]))
+    )
+    consumed_quotas = list(result)
+
+    counted_scopes = {q.scope for q in consumed_quotas}
+    missing_definitions = [
+        d for d in quota_definitions if d.scope not in counted_scopes and len(keys[d.scope]) > 1
+    ]
+    if missing_definitions:
+        revision = await next_quota_revision(db)
+        created_quotas = []
+        for quota_definition in missing_definitions:
+            created_quotas += await create_consumption_counter(
+                db, quota_definition, keys[quota_definition.scope], 0, revision
+            )
+        await load_effective_limits(db, created_quotas)
+        await db.commit()
+        # Cached quotas of existing counters stay valid, their pending usage is added when serialized
+        quota_cache.invalidate(created_quotas)
+        consumed_quotas += created_quotas
+
+    while usage_buffer.flushes != flushes:
+        # A flush committed while the counters were read, they may predate it although its usage is no
+        # longer in the buffer. The read transaction ends first, so that the rows are read again.
+        flushes = usage_buffer.flushes
+        await db.commit()
+        result = await db.scalars(
+            select(models.Quota).where(models.Quota.id.in_([q.id for q in consumed_quotas]))
+            .execution_options(populate_existing=True)
+        )
+        consumed_quotas = list(result)
+
+    exceeded = [q.scope for q in consumed_quotas if is_exceeded(q, (usage_buffer.used(q) or 0) + consumption.amount)]
+    if exceeded:
+        raise_quota_exceeded(exceeded)
+
+    for quota in consumed_quotas:
+        usage_buffer.add(quota, consumption.amount)
+    return consumed_quotas
+
+
+async def get_effective_quotas(db: AsyncSession, subject: schemas.QuotaSubject) -> list[tuple[models.Quota, models.Quota | None]]:
+    # Per scope the most specific quota defining the limit and the counter of the usage, None if nothing was consumed
+    quota_definitions = applicable_quota_definitions(await definitions.get_all(db), subject)
+    keys = {d.scope: consumption_keys(d.scope, subject) for d in quota_definitions}
+    if not quota_definitions:
+        return []
+
+    result = await db.scalars(select(models.Quota).where(or_(*[
+        quota_key_filter(d, *key) for d in quota_definitions for key in keys[d.scope]
+    ])))
+    quotas = {(q.scope, q.course_id, q.user_id): q for q in result}
+
+    effective_quotas = []
+    for quota_definition in quota_definitions:
+        scope_quotas = [quotas.get((quota_definition.scope, *key)) for key in keys[quota_definition.scope]]
+        limit_quota = next((q for q in scope_quotas if q is not None), None)
+        if limit_quota is not None:
+            effective_quotas.append((limit_quota, scope_quotas[0]))
+    return effective_quotas
+
+
+async def get_usage(db: AsyncSession, query: schemas.UsageQuery) -> list[tuple]:
+    # Amount and number of consumptions per hour or day from the aggregated buckets, which lag until the next rollup
+    conditions = [models.UsageBucket.granularity == query.granularity]
+    if query.start is not None:
+        conditions.append(models.UsageBucket.start >= as_utc(query.start))
+    if query.end is not None:
+        conditions.append(models.UsageBucket.start < as_utc(query.end))
+    for column in ("user_id", "course_id", "feature", "type"):
+        if getattr(query, column) is not None:
+            conditions.append(getattr(models.UsageBucket, column) == getattr(query, column))
+
+    result = await db.execute(
+        select(models.UsageBucket.start, func.sum(models.UsageBucket.amount), func.sum(models.UsageBucket.events))
+        .where(*conditions)
+        .group_by(models.UsageBucket.start)
+        .order_by(models.UsageBucket.start)
+    )
+    return result.all()
@@ -1,27 +1,72 @@
+import asyncio
 import os
 import logging
-from fastapi import FastAPI, Depends, Form
-from fastapi.responses import HTMLResponse
+import orjson
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, Form, Header, Query, Request, Response
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from typing import List
-from sqlalchemy.orm import Session
+from typing import Dict, List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import crud
 import models
-from schemas import QuotaGet, QuotaUpdate, Metadata
+import snapshot
+from coherence import coherence
+from schemas import ResetIntervalDefinition, QuotaGet, QuotaUpdate, CourseQuotaQuery, QuotaSubject, QuotaConsume, QuotaResolution, UsageBucket, UsageQuery, Metadata
 from database import engine, SessionLocal, get_db
-from seed import seed_data
-from utils import verify_token, verify_api_key
+from rate_limit import rate_limiter
+from registry import definitions
+from reset import RESET_SCHEDULER, current_period, run_reset_scheduler
+from usage_buffer import usage_buffer
+from usage_events import run_usage_rollup, usage_events
+from metrics import METRICS_ENABLED, MetricsMiddleware, instrument_engine, render_metrics, timed
+from migrations import prepare_database
+from notifications import QUOTA_EVENTS_KEEPALIVE, QUOTA_EVENTS_MAX_LIFETIME, QUOTA_EVENTS_RETRY, quota_hub
+from utils import load_verification_keys, verify_token, verify_api_key, make_etag, etag_matches
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-models.Base.metadata.create_all(bind=engine)
 
-with SessionLocal() as session:
-    # Create mock data
-    seed_data(session)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Unreadable key files fail the start, jose is imported while the database is prepared
+    keys_loaded = asyncio.create_task(asyncio.to_thread(load_verification_keys))
+    await prepare_database()
+    await coherence.start()
 
-app = FastAPI()
+    async with SessionLocal() as session:
+        await definitions.load(session)
+    await keys_loaded
+
+    usage_buffer.start()
+    usage_events.start()
+    stopping = asyncio.Event()
+    background_tasks = []
+    if RESET_SCHEDULER:
+        background_tasks.append(asyncio.create_task(run_reset_scheduler(stopping)))
+    if usage_events.enabled:
+        background_tasks.append(asyncio.create_task(run_usage_rollup(stopping)))
+    yield
+    # Not cancelled, a reset or rollup in progress stops after its current chunk and releases its connection
+    stopping.set()
+    await asyncio.gather(*background_tasks)
+    await coherence.stop()
+    await usage_buffer.stop()
+    await usage_events.stop()
+    await engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+if METRICS_ENABLED:
+    instrument_engine(engine)
+    app.add_middleware(MetricsMiddleware)
+
+    # Endpoint to scrape request metrics in the Prometheus text format
+    @app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+    async def get_metrics():
+        return render_metrics()
 
 # Static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -44,11 +89,9 @@ async def access_tool(token: str = Form()):
     """
 
 
-# Endpoint to get metadata (API Key protected)
-@app.get("/metadata", response_model=Metadata, response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def get_metadata(db: Session = Depends(get_db)):
+# Helper function to build the metadata document from the quota definitions
+def build_metadata(quota_definitions_objects: list[models.QuotaDefinition]) -> Metadata:
     base_url = os.getenv("HOST_URL")  # Read the environment variable for host URL
-    quota_definitions_objects = crud.get_quota_definitions(db)
 
     quota_definitions = []
     for quota_definition in quota_definitions_objects:
@@ -58,9 +101,11 @@ async def get_metadata(db: Session = Depends(get_db)):
             "reset_interval": quota_definition.reset_interval,
             "scope": quota_definition.scope,
             "feature": quota_definition.feature,
+            "burst_limit": quota_definition.burst_limit,
+            "refill_per_second": quota_definition.refill_per_second,
         })
 
-    return {
+    return Metadata(**{
         "tool_url": f"{base_url}",
         "quota_url": f"{base_url}/quota",
         "image_url": f"{base_url}/static/kiwi.png",
@@ -73,70 +118,283 @@ async def get_metadata(db: Session = Depends(get_db)):
             "en-GB": "Test Tool Title"
         },
         "supported_quotas": quota_definitions
-    }
+    })
+
+
+# Serialized /metadata body, only rebuilt when the definitions registry was reloaded
+metadata_cache = {"generation": None, "body": b"", "etag": ""}
+
+
+# Endpoint to get metadata (API Key protected)
+@app.get("/metadata", response_model=Metadata, response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
+async def get_metadata(db: AsyncSession = Depends(get_db), if_none_match: Optional[str] = Header(None)):
+    quota_definitions_objects = await crud.get_quota_definitions(db)
+
+    if metadata_cache["generation"] != definitions.generation:
+        with timed("serialize"):
+            body = build_metadata(quota_definitions_objects).model_dump_json(exclude_none=True).encode()
+        metadata_cache.update(generation=definitions.generation, body=body, etag=make_etag(body))
+
+    headers = {"ETag": metadata_cache["etag"], "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, metadata_cache["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=metadata_cache["body"], media_type="application/json", headers=headers)
+
+
+# Helper function to convert quotas to the QuotaGet wire format, omitting None fields like response_model_exclude_none
+def serialize_quota(quota: models.Quota) -> dict:
+    serialized = {"limit": quota.effective_limit}
+    used = usage_buffer.used(quota)
+    if used is not None:
+        serialized["used"] = used
+    if quota.type is not None:
+        serialized["type"] = quota.type
+    serialized["scope"] = quota.scope.value
+    if quota.feature is not None:
+        serialized["feature"] = quota.feature
+    if quota.user_id is not None:
+        serialized["user_id"] = quota.user_id
+    quota_definition = definitions.by_id.get(quota.quota_definition_id)
+    if quota_definition is not None and quota_definition.burst_limit is not None:
+        key = crud.rate_limit_key(quota_definition, quota.course_id, quota.user_id) if crud.is_consumption_counter(quota) else None
+        serialized["rate_limit"] = serialize_rate_limit(quota_definition, key)
+    return serialized
+
+
+# Helper function to convert the rate limit of a quota definition and, for a bucket key, its current state
+def serialize_rate_limit(quota_definition: models.QuotaDefinition, key: tuple = None) -> dict:
+    serialized = {"burst_limit": quota_definition.burst_limit}
+    if quota_definition.refill_per_second is not None:
+        serialized["refill_per_second"] = quota_definition.refill_per_second
+    if key is not None:
+        serialized["available"] = int(rate_limiter.available(quota_definition, key))
+    return serialized
+
+
+# Helper function to serialize written quotas and push them to the subscribers of their changes
+def publish_quotas(quotas: list[models.Quota]) -> list[dict]:
+    serialized = [serialize_quota(q) for q in quotas]
+    quota_hub.publish(list(zip(quotas, serialized)))
+    return serialized
+
+
+class QuotaResponse(Response):
+    """
+    JSON response for already serialized quotas.
+
+    Routes keep their response_model for the OpenAPI schema, but returning this response skips
+    FastAPI's validation of the content against it.
+    """
+    media_type = "application/json"
 
+    def render(self, content) -> bytes:
+        with timed("serialize"):
+            return orjson.dumps(content)
 
-# Helper function to ensure quotas have all fields
-def validate_quota(quota: models.Quota):
-    return {
-        "limit": quota.limit,
-        "used": quota.used,
-        "type": quota.type,
-        "scope": quota.scope,
-        "feature": quota.feature,
-        "user_id": quota.user_id
-    }
 
+# Helper function to build the validator headers of a quota listing at a revision
+def revision_headers(revision: int, version: str, since: Optional[int], course_id: Optional[str]) -> dict:
+    # Lazily reset counters change their used value when a period ends, without a new revision.
+    # Usage in the buffer, pending or being flushed, is not part of any revision yet.
+    periods = ",".join(str(current_period(interval)) for interval in ResetIntervalDefinition)
+    changes = usage_buffer.listing_changes(course_id)
+    etag = make_etag(f"{version}:{since}:{periods}:{changes}".encode())
+    return {"ETag": etag, "X-Quota-Revision": str(revision), "Cache-Control": "private, no-cache"}
 
-# Endpoint to get quotas (API Key protected)
+
+# Helper function to read the revision of a quota listing before the quotas
+async def listing_revision(db: AsyncSession, course_id: Optional[str], since: Optional[int]) -> tuple[Optional[int], dict]:
+    # A concurrent write then only makes the next delta repeat a row
+    revision, version = await crud.get_quota_revision(db, course_id)
+    if since is not None and since > revision:
+        # Revision of another database, e.g. before a restore, the client gets the complete listing
+        since = None
+    return since, revision_headers(revision, version, since, course_id)
+
+
+# Endpoint to get quotas, optionally only those changed after a revision (API Key protected)
 @app.get("/quota", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def get_quotas(db: Session = Depends(get_db)):
-    quotas = crud.get_global_quotas(db)
-    validated_quotas = [validate_quota(q) for q in quotas]
-    return validated_quotas
+async def get_quotas(since: Optional[int] = Query(None, ge=0), if_none_match: Optional[str] = Header(None),
+                     db: AsyncSession = Depends(get_db)):
+    since, headers = await listing_revision(db, None, since)
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    quotas = await crud.get_global_quotas(db, since)
+    return QuotaResponse([serialize_quota(q) for q in quotas], headers=headers)
 
 
 # Endpoint to update quotas (API Key protected)
 @app.put("/quota", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def put_quotas(quotas: List[QuotaUpdate], db: Session = Depends(get_db)):
+async def put_quotas(quotas: List[QuotaUpdate], db: AsyncSession = Depends(get_db)):
     # Update passed quotas
-    for quota in quotas:
-        crud.update_or_create_global_quota(db, quota)
+    global_quotas = await crud.update_or_create_global_quotas(db, quotas)
+    return QuotaResponse(publish_quotas(global_quotas))
+
+
+# Endpoint to consume quotas of a user, optionally within a course (API Key protected)
+@app.post("/quota/consume", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
+async def consume_quota(consumption: QuotaConsume, db: AsyncSession = Depends(get_db)):
+    quotas = await crud.consume_quota(db, consumption)
+    return QuotaResponse(publish_quotas(quotas))
+
+
+# Endpoint to get the remaining quota of a user, optionally within a course, across all scopes (API Key protected)
+@app.get("/quota/effective", response_model=QuotaResolution, response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
+async def get_effective_quota(subject: QuotaSubject = Depends(), db: AsyncSession = Depends(get_db)):
+    quotas = []
+    for limit_quota, counter_quota in await crud.get_effective_quotas(db, subject):
+        used = (usage_buffer.used(counter_quota) or 0) if counter_quota is not None else 0
+        quota = {
+            "limit": limit_quota.effective_limit,
+            "used": used,
+            "remaining": max(limit_quota.effective_limit - used, 0),
+            "type": limit_quota.type,
+            "scope": limit_quota.scope.value,
+        }
+        if limit_quota.feature is not None:
+            quota["feature"] = limit_quota.feature
+        quota_definition = definitions.by_id.get(limit_quota.quota_definition_id)
+        if quota_definition is not None and quota_definition.burst_limit is not None:
+            key = crud.rate_limit_key(quota_definition, *crud.consumption_keys(quota_definition.scope, subject)[0])
+            quota["rate_limit"] = serialize_rate_limit(quota_definition, key)
+        quotas.append(quota)
+
+    resolution = {}
+    if quotas:
+        resolution["remaining"] = min(q["remaining"] for q in quotas)
+    resolution["quotas"] = quotas
+    return QuotaResponse(resolution)
+
+
+# Endpoint to subscribe to changes of the quotas that apply to a course and/or user as server-sent events (API Key protected)
+@app.get("/quota/events", dependencies=[Depends(verify_api_key)])
+async def subscribe_quota_events(course_id: Optional[str] = None, user_id: Optional[str] = None):
+    return StreamingResponse(stream_quota_events(course_id, user_id), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Keep reverse proxies from buffering the events
+        "X-Accel-Buffering": "no",
+    })
+
+
+async def stream_quota_events(course_id: Optional[str], user_id: Optional[str]):
+    subscription = quota_hub.subscribe(course_id, user_id)
+    # Streams end after a while so open subscriptions never keep a shutting down worker alive,
+    # EventSource clients reconnect after the retry delay
+    ends = asyncio.get_running_loop().time() + QUOTA_EVENTS_MAX_LIFETIME
+    try:
+        # Sent once subscribed, quotas fetched afterwards miss no change
+        yield f"retry: {QUOTA_EVENTS_RETRY}\n: subscribed\n\n".encode()
+        while (remaining := ends - asyncio.get_running_loop().time()) > 0:
+            if not await subscription.wait(min(QUOTA_EVENTS_KEEPALIVE, remaining)):
+                # Comment line that keeps idle connections from timing out
+                yield b": keepalive\n\n"
+                continue
+            replaced, quotas = subscription.take()
+            if replaced:
+                yield b"event: replaced\ndata: {}\n\n"
+            if quotas:
+                yield b"event: quotas\ndata: " + orjson.dumps(quotas) + b"\n\n"
+    finally:
+        quota_hub.unsubscribe(subscription)
+
 
-    global_quotas = crud.get_global_quotas(db)
-    validated_quotas = [validate_quota(q) for q in global_quotas]
-    return validated_quotas
+# Endpoint to get the aggregated usage per hour or day, optionally of a user, course, feature or type (API Key protected)
+@app.get("/usage", response_model=List[UsageBucket], dependencies=[Depends(verify_api_key)])
+async def get_usage(query: UsageQuery = Depends(), db: AsyncSession = Depends(get_db)):
+    buckets = await crud.get_usage(db, query)
+    return QuotaResponse([{"start": start, "amount": amount, "events": events} for start, amount, events in buckets])
 
 
-# Endpoint to get quota for a specific course with user quotas option (API Key protected)
+# Endpoint to export all quota definitions and quotas as gzip-compressed NDJSON (API Key protected)
+@app.get("/snapshot", dependencies=[Depends(verify_api_key)])
+async def export_snapshot():
+    # Pending usage is part of the snapshot
+    await usage_buffer.flush()
+    return StreamingResponse(stream_snapshot(), media_type="application/gzip", headers={
+        "Content-Disposition": 'attachment; filename="quota-snapshot.ndjson.gz"'
+    })
+
+
+async def stream_snapshot():
+    # The stream outlives the request scoped session, so it uses its own
+    async with SessionLocal() as db:
+        async for chunk in snapshot.export_snapshot(db):
+            yield chunk
+
+
+# Endpoint to replace all quota definitions and quotas with an exported snapshot (API Key protected)
+@app.put("/snapshot", dependencies=[Depends(verify_api_key)])
+async def import_snapshot(request: Request, db: AsyncSession = Depends(get_db)):
+    # Pending usage refers to the replaced quotas
+    await usage_buffer.flush()
+    counts = await snapshot.import_snapshot(db, request.stream())
+    quota_hub.publish_replaced()
+    return counts
+
+
+# Endpoint to get quota for a specific course, optionally only those changed after a revision (API Key protected)
 @app.get("/quota/course/{course_id}", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def get_course_quota(course_id: str, db: Session = Depends(get_db)):
-    quotas = crud.get_course_quotas(db, course_id)
-    validated_quotas = [validate_quota(q) for q in quotas]
-    return validated_quotas
+async def get_course_quota(course_id: str, since: Optional[int] = Query(None, ge=0), if_none_match: Optional[str] = Header(None),
+                           db: AsyncSession = Depends(get_db)):
+    if since is not None:
+        since, headers = await listing_revision(db, course_id, since)
+    if since is None:
+        # The complete listing is usually cached with the revision it was read at
+        quotas = await crud.get_course_quotas(db, course_id)
+        headers = revision_headers(quotas.revision, quotas.version, since, course_id)
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if since is not None:
+        quotas = await crud.get_course_quotas(db, course_id, since)
+    return QuotaResponse([serialize_quota(q) for q in quotas], headers=headers)
 
 
 # Endpoint to update quota for a course and course members (API Key protected)
 @app.put("/quota/course/{course_id}", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def put_course_quota(course_id: str, quotas: List[QuotaUpdate], db: Session = Depends(get_db)):
-    for quota in quotas:
-        crud.update_or_create_course_quota(db, course_id, quota)
+async def put_course_quota(course_id: str, quotas: List[QuotaUpdate], db: AsyncSession = Depends(get_db)):
+    course_quotas = await crud.update_or_create_course_quotas(db, course_id, quotas)
+    return QuotaResponse(publish_quotas(course_quotas))
 
-    course_quotas = crud.get_course_quotas(db, course_id)
-    validated_quotas = [validate_quota(q) for q in course_quotas]
-    return validated_quotas
 
+# Endpoint to get quotas of several courses, optionally with course member quotas (API Key protected)
+@app.post("/quota/courses", response_model=Dict[str, List[QuotaGet]], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
+async def get_courses_quotas(query: CourseQuotaQuery, db: AsyncSession = Depends(get_db)):
+    courses_quotas = await crud.get_courses_quotas(db, query.course_ids, query.user_ids)
+    return QuotaResponse({
+        course_id: [serialize_quota(q) for q in quotas] for course_id, quotas in courses_quotas.items()
+    })
 
-# Endpoint to get quota for all course members (API Key protected)
+
+# Endpoint to get quota for all course members, paginated or streamed as NDJSON (API Key protected)
 @app.get("/quota/course/{course_id}/user", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def get_course_member_quotas(course_id: str, db: Session = Depends(get_db)):
-    quotas = crud.get_course_quotas(db, course_id)
-    validated_quotas = [validate_quota(q) for q in quotas]
-    return validated_quotas
+async def get_course_member_quotas(course_id: str, limit: Optional[int] = Query(None, gt=0),
+                                   after: Optional[str] = None, stream: bool = False, db: AsyncSession = Depends(get_db)):
+    if stream:
+        return StreamingResponse(stream_course_member_quotas(course_id), media_type="application/x-ndjson")
+
+    quotas = await crud.get_course_member_quotas(db, course_id, limit, after)
+    response = QuotaResponse([serialize_quota(q) for q in quotas])
+    if limit and len(quotas) == limit:
+        response.headers["X-Next-Cursor"] = crud.make_cursor(quotas[-1])
+    return response
+
+
+async def stream_course_member_quotas(course_id: str):
+    # The stream outlives the request scoped session, so it uses its own
+    async with SessionLocal() as db:
+        async for quota in crud.stream_course_member_quotas(db, course_id):
+            yield orjson.dumps(serialize_quota(quota)) + b"\n"
 
 
 # Endpoint to get quota for a specific course member (API Key protected)
 @app.get("/quota/course/{course_id}/user/{user_id}", response_model=QuotaGet, response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
-async def get_course_member_quota(course_id: str, user_id: str, db: Session = Depends(get_db)):
-    quota = crud.get_course_member_quota(db, course_id, user_id)
-    return validate_quota(quota)
+async def get_course_member_quota(course_id: str, user_id: str, db: AsyncSession = Depends(get_db)):
+    quota = await crud.get_course_member_quota(db, course_id, user_id)
+    return QuotaResponse(serialize_quota(quota))
+
+
+# Endpoint to override the quota of a specific course member (API Key protected)
+@app.put("/quota/course/{course_id}/user/{user_id}", response_model=List[QuotaGet], response_model_exclude_none=True, dependencies=[Depends(verify_api_key)])
+async def put_course_member_quota(course_id: str, user_id: str, quotas: List[QuotaUpdate], db: AsyncSession = Depends(get_db)):
+    member_quotas = await crud.update_or_create_course_member_quotas(db, course_id, user_id, quotas)
+    return QuotaResponse(publish_quotas(member_quotas))
@@ -0,0 +1,173 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from quota_cache import quota_cache
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+
+# Upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class RequestTimings:
+    """Time spent by the current request, split by database, auth and serialization."""
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.phases: dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, total_seconds: float) -> str:
+        entries = [f"app;dur={total_seconds * 1000:.2f}",
+                   f'db;dur={self.sql_seconds * 1000:.2f};desc="{self.sql_statements} statements"']
+        entries += [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in self.phases.items()]
+        return ", ".join(entries)
+
+
+current_timings: ContextVar[RequestTimings | None] = ContextVar("current_timings", default=None)
+
+
+@contextmanager
+def timed(phase: str):
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.phases: dict[str, float] = {}
+
+    def observe(self, seconds: float, timings: RequestTimings):
+        self.requests += 1
+        self.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.sql_statements += timings.sql_statements
+        self.sql_seconds += timings.sql_seconds
+        for phase, phase_seconds in timings.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + phase_seconds
+
+
+# Metrics per (method, route path, status)
+route_metrics: dict[tuple[str, str, int], RouteMetrics] = {}
+
+
+def render_metrics() -> str:
+    """All collected metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP http_request_duration_seconds Request latency by route",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, path, status), metrics in route_metrics.items():
+        labels = f'method="{method}",route="{path}",status="{status}"'
+        for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metrics.requests}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {metrics.seconds}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {metrics.requests}")
+
+    lines += ["# HELP http_request_sql_statements_total SQL statements executed by route",
+              "# TYPE http_request_sql_statements_total counter"]
+    for (method, path, status), metrics in route_metrics.items():
+        lines.append(f'http_request_sql_statements_total{{method="{method}",route="{path}",status="{status}"}} '
+                     f'{metrics.sql_statements}')
+
+    lines += ["# HELP http_request_phase_seconds_total Time spent in database, auth and serialization by route",
+              "# TYPE http_request_phase_seconds_total counter"]
+    for (method, path, status), metrics in route_metrics.items():
+        labels = f'method="{method}",route="{path}",status="{status}"'
+        lines.append(f'http_request_phase_seconds_total{{{labels},phase="db"}} {metrics.sql_seconds}')
+        for phase, seconds in metrics.phases.items():
+            lines.append(f'http_request_phase_seconds_total{{{labels},phase="{phase}"}} {seconds}')
+
+    lines += ["# HELP quota_cache_requests_total Course and course member quota lookups by cache result",
+              "# TYPE quota_cache_requests_total counter",
+              f'quota_cache_requests_total{{result="hit"}} {quota_cache.hits}',
+              f'quota_cache_requests_total{{result="miss"}} {quota_cache.misses}',
+              "# HELP quota_cache_evictions_total Cache entries dropped for size or age",
+              "# TYPE quota_cache_evictions_total counter",
+              f"quota_cache_evictions_total {quota_cache.evictions}",
+              "# HELP quota_cache_invalidations_total Invalidations of cache entries by quota writes",
+              "# TYPE quota_cache_invalidations_total counter",
+              f"quota_cache_invalidations_total {quota_cache.invalidations}",
+              "# HELP quota_cache_entries Cached lookups",
+              "# TYPE quota_cache_entries gauge",
+              f"quota_cache_entries {len(quota_cache.entries)}",
+              "# HELP quota_cache_quotas Quotas held by cached lookups",
+              "# TYPE quota_cache_quotas gauge",
+              f"quota_cache_quotas {quota_cache.size}"]
+    return "\n".join(lines) + "\n"
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Count SQL statements and their duration for the request that executes them."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        timings = current_timings.get()
+        if timings is not None:
+            timings.sql_statements += 1
+            timings.sql_seconds += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """Records latency, SQL and phase timings per route and reports them in a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.server_timing(time.perf_counter() - start).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            seconds = time.perf_counter() - start
+            current_timings.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            key = (scope["method"], path, status)
+            if key not in route_metrics:
+                route_metrics[key] = RouteMetrics()
+            route_metrics[key].observe(seconds, timings)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from sqlalchemy import BigInteger, and_, delete, inspect, insert, or_, select, text, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+import models
+import schemas
+from database import engine, is_sqlite, url
+from reset import current_period
+from seed import seed_data
+
+# Version of the schema and seed data, to be incremented with every new migration step. Databases at
+# this version are not touched on startup.
+SCHEMA_VERSION = 10
+
+# Arbitrary key of the PostgreSQL advisory lock held while the database is prepared
+ADVISORY_LOCK_KEY = 4_711_001
+
+
+def upgrade_quota_indexes(conn: Connection):
+    # Duplicates of a key could exist before it was unique, keep the oldest row which lookups returned
+    conn.execute(text(
+        "DELETE FROM quota WHERE id NOT IN ("
+        "SELECT min(id) FROM quota "
+        "GROUP BY scope, coalesce(feature, ''), coalesce(course_id, ''), coalesce(user_id, ''))"
+    ))
+    # Replaced by ix_quota_listing_revision, which also covers user_id and scope
+    conn.execute(text("DROP INDEX IF EXISTS ix_quota_revision"))
+    for index in models.Quota.__table__.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def add_quota_period(conn: Connection):
+    if "period" in {column["name"] for column in inspect(conn).get_columns("quota")}:
+        return
+
+    conn.execute(text("ALTER TABLE quota ADD COLUMN period VARCHAR"))
+    # Existing usage counts for the current period instead of being reset right away
+    quota_definitions = conn.execute(select(models.QuotaDefinition.id, models.QuotaDefinition.reset_interval))
+    for quota_definition_id, reset_interval in quota_definitions:
+        conn.execute(
+            update(models.Quota)
+            .where(models.Quota.quota_definition_id == quota_definition_id)
+            .values(period=current_period(reset_interval))
+        )
+
+
+def add_rate_limits(conn: Connection):
+    columns = {column["name"] for column in inspect(conn).get_columns("quota_definition")}
+    if "burst_limit" not in columns:
+        conn.execute(text("ALTER TABLE quota_definition ADD COLUMN burst_limit INTEGER"))
+    if "refill_per_second" not in columns:
+        conn.execute(text("ALTER TABLE quota_definition ADD COLUMN refill_per_second FLOAT"))
+
+
+def add_quota_revision(conn: Connection):
+    if "revision" not in {column["name"] for column in inspect(conn).get_columns("quota")}:
+        conn.execute(text("ALTER TABLE quota ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"))
+
+
+def widen_quota_revision(conn: Connection):
+    # Revisions are transaction ids on PostgreSQL, SQLite integers have 64 bits anyway
+    revision = next(column for column in inspect(conn).get_columns("quota") if column["name"] == "revision")
+    if conn.dialect.name == "postgresql" and not isinstance(revision["type"], BigInteger):
+        conn.execute(text("ALTER TABLE quota ALTER COLUMN revision TYPE BIGINT"))
+
+
+def make_quota_limit_nullable(conn: Connection):
+    limit = next(column for column in inspect(conn).get_columns("quota") if column["name"] == "limit")
+    if limit["nullable"]:
+        return
+
+    if conn.dialect.name != "sqlite":
+        conn.execute(text('ALTER TABLE quota ALTER COLUMN "limit" DROP NOT NULL'))
+    else:
+        # SQLite cannot alter columns, the table is rebuilt with the same rows
+        columns = ", ".join(f'"{column["name"]}"' for column in inspect(conn).get_columns("quota"))
+        for index in models.Quota.__table__.indexes:
+            conn.execute(DropIndex(index, if_exists=True))
+        conn.execute(text("ALTER TABLE quota RENAME TO quota_old"))
+        models.Quota.__table__.create(conn)
+        conn.execute(text(f"INSERT INTO quota ({columns}) SELECT {columns} FROM quota_old"))
+        conn.execute(text("DROP TABLE quota_old"))
+
+    # Counters copied the limit they inherited when they were created. Those still equal to it inherit it
+    # from now on, the others remain overrides.
+    quota = models.Quota
+    conn.execute(
+        update(quota)
+        .where(
+            or_(
+                and_(quota.scope == schemas.QuotaScope.user, quota.user_id != None),
+                and_(quota.scope == schemas.QuotaScope.course, quota.course_id != None, quota.user_id == None),
+                and_(quota.scope == schemas.QuotaScope.course_user, quota.course_id != None, quota.user_id != None),
+            ),
+            quota.limit == models.QUOTA_INHERITED_LIMIT
+        )
+        .values(limit=None)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def migrate(conn: AsyncConnection):
+    """
+    Bring an existing database to the current schema.
+
+    create_all() only creates missing tables, so changes to existing tables are applied here. Every step
+    has to be idempotent.
+    """
+    # Before the indexes are created, one of them covers the column
+    await conn.run_sync(add_quota_revision)
+    await conn.run_sync(widen_quota_revision)
+    await conn.run_sync(upgrade_quota_indexes)
+    await conn.run_sync(add_quota_period)
+    await conn.run_sync(add_rate_limits)
+    await conn.run_sync(make_quota_limit_nullable)
+
+
+def read_schema_version(conn: Connection) -> int | None:
+    if not inspect(conn).has_table(models.SchemaVersion.__tablename__):
+        return None
+    return conn.scalar(select(models.SchemaVersion.version))
+
+
+def write_schema_version(conn: Connection):
+    conn.execute(delete(models.SchemaVersion))
+    conn.execute(insert(models.SchemaVersion).values(version=SCHEMA_VERSION))
+
+
+def lock_file_path() -> str:
+    # Next to a SQLite database file, all workers using the database share it
+    if is_sqlite and url.database not in (None, "", ":memory:"):
+        return url.database + ".lock"
+    return os.getenv("MIGRATION_LOCK_FILE", "migration.lock")
+
+
+@asynccontextmanager
+async def migration_lock(conn: AsyncConnection):
+    """Serialize the preparation of the database across worker processes."""
+    if conn.dialect.name == "postgresql":
+        # Released with the transaction of conn
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": ADVISORY_LOCK_KEY})
+        yield
+        return
+
+    import fcntl
+
+    with open(lock_file_path(), "a") as lock_file:
+        # flock blocks until the lock is free, which must not block the event loop
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_prepared(version: int | None) -> bool:
+    if version is not None and version > SCHEMA_VERSION:
+        # Migrating back could drop data of the newer schema
+        raise RuntimeError(
+            f"Database has schema version {version}, newer than {SCHEMA_VERSION} of this code, refusing to start"
+        )
+    return version == SCHEMA_VERSION
+
+
+async def prepare_database() -> bool:
+    """
+    Create, migrate and seed the database once for all workers, returns whether anything was done.
+
+    Workers of an already prepared database only read the schema version. Otherwise the first worker
+    to get the migration lock prepares the database in one transaction and records SCHEMA_VERSION,
+    the others wait for the lock and then find the version current. A database of a newer version,
+    e.g. during the rollback of a deployment, is not touched and the worker fails to start.
+    """
+    async with engine.connect() as conn:
+        if is_prepared(await conn.run_sync(read_schema_version)):
+            return False
+
+    async with engine.begin() as conn:
+        async with migration_lock(conn):
+            if is_prepared(await conn.run_sync(read_schema_version)):
+                return False
+
+            await conn.run_sync(models.Base.metadata.create_all)
+            await migrate(conn)
+            # Create mock data, the session joins the transaction of conn
+            async with AsyncSession(bind=conn, expire_on_commit=False) as session:
+                await seed_data(session)
+            await conn.run_sync(write_schema_version)
+
+    logging.info(f"Database prepared for schema version {SCHEMA_VERSION}")
+    return True
+
+
+async def main():
+    await prepare_database()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
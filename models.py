@@ -1,8 +1,8 @@
-from sqlalchemy import Column, String, Enum, Integer, Table, ForeignKey, JSON, UniqueConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Column, String, Enum, Integer, Float, DateTime, Table, ForeignKey, JSON, UniqueConstraint, Index, func, literal_column, select
+from sqlalchemy.orm import column_property, relationship
 
 from database import Base
-from schemas import ResetIntervalDefinition, QuotaScope
+from schemas import ResetIntervalDefinition, QuotaScope, UsageGranularity
 
 
 class QuotaDefinition(Base):
@@ -15,6 +15,9 @@ class QuotaDefinition(Base):
     reset_interval = Column(Enum(ResetIntervalDefinition), nullable=True)
     scope = Column(Enum(QuotaScope), nullable=False)
     feature = Column(String, nullable=True)
+    # Token bucket rate limit of the consumption, see rate_limit.py, None for no limit
+    burst_limit = Column(Integer, nullable=True)
+    refill_per_second = Column(Float, nullable=True)
 
     class Config:
         from_attributes = True
@@ -22,20 +25,130 @@ class QuotaDefinition(Base):
 
 class Quota(Base):
     __tablename__ = 'quota'
-    # TODO: Null values are interpreted as distinct values, see https://www.sqlite.org/nulls.html
-    __table_args__ = (UniqueConstraint('scope', 'feature', 'user_id', 'course_id',  name='uq_key'),)
+    __table_args__ = (
+        # Serves global (course_id IS NULL), course and course member lookups
+        Index('ix_quota_lookup', 'course_id', 'scope', 'user_id', 'feature'),
+        Index('ix_quota_definition_id', 'quota_definition_id'),
+        # Revision checks and changes since a revision of the global (course_id IS NULL) and course
+        # listings, which leave out counters and course members (user_id IS NOT NULL)
+        Index('ix_quota_listing_revision', 'course_id', 'user_id', 'scope', 'revision'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    limit = Column(Integer, nullable=False)
+    # None for consumption counters without own limit, see Quota.effective_limit
+    limit = Column(Integer, nullable=True)
     used = Column(Integer, nullable=True)
+    period = Column(String, nullable=True)  # Reset period the used value belongs to, see reset.current_period
     type = Column(String, nullable=True)  # TODO: Do we need type because defined in quota definition
     scope = Column(Enum(QuotaScope), nullable=False)  # TODO: Do we need scope because defined in quota definition
     feature = Column(String, nullable=True)  # TODO: Do we need feature because defined in quota definition
     user_id = Column(String, nullable=True)
     course_id = Column(String, nullable=True)
     quota_definition_id = Column(Integer, ForeignKey('quota_definition.id'), nullable=False)
+    # Quota revision of the last change, see coherence.next_quota_revision
+    revision = Column(BigInteger, nullable=False, default=0, server_default="0")
 
     quota_definition = relationship('QuotaDefinition', backref='quota')
 
     class Config:
         from_attributes = True
+
+
+# NULL values are distinct in unique constraints (see https://www.sqlite.org/nulls.html), so the key
+# is made unique on the NULL-safe coalesced columns. Upserts use the same expressions as conflict target.
+QUOTA_KEY = (
+    Quota.scope,
+    func.coalesce(Quota.feature, literal_column("''")),
+    func.coalesce(Quota.course_id, literal_column("''")),
+    func.coalesce(Quota.user_id, literal_column("''")),
+)
+
+Index('uq_quota_key', *QUOTA_KEY, unique=True)
+
+# Limit a quota inherits from the most specific stored limit of its scope and feature without user: the
+# one of its course, otherwise the global one. Uses the uq_quota_key index.
+parent_quota = Quota.__table__.alias("parent_quota")
+QUOTA_INHERITED_LIMIT = select(parent_quota.c.limit).where(
+    parent_quota.c.scope == Quota.scope,
+    func.coalesce(parent_quota.c.feature, literal_column("''")) == func.coalesce(Quota.feature, literal_column("''")),
+    func.coalesce(parent_quota.c.course_id, literal_column("''")).in_(
+        [func.coalesce(Quota.course_id, literal_column("''")), literal_column("''")]
+    ),
+    func.coalesce(parent_quota.c.user_id, literal_column("''")) == literal_column("''"),
+    parent_quota.c.id != Quota.id,
+    parent_quota.c.limit != None
+).order_by(parent_quota.c.course_id.is_(None)).limit(1).correlate_except(parent_quota).scalar_subquery()
+
+# The own limit of quotas with one, e.g. overrides, otherwise the inherited one. Loaded by SELECTs of
+# quotas, but not by INSERT or UPDATE ... RETURNING, see crud.load_effective_limits.
+Quota.effective_limit = column_property(func.coalesce(Quota.limit, QUOTA_INHERITED_LIMIT))
+
+
+class SchemaVersion(Base):
+    # Single row with the version of the schema and seed data the database was prepared for
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+
+
+class CacheGeneration(Base):
+    # Incremented on every write to the data cached under the channel, see coherence.DatabaseBackend
+    __tablename__ = 'cache_generation'
+
+    channel = Column(String, primary_key=True)
+    generation = Column(Integer, nullable=False)
+
+
+class UsageEvent(Base):
+    # Append-only record of every consumption, see usage_events.py
+    __tablename__ = 'usage_event'
+    __table_args__ = (
+        Index('ix_usage_event_user', 'user_id', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, nullable=False)  # UTC
+    amount = Column(Integer, nullable=False)
+    user_id = Column(String, nullable=False)
+    course_id = Column(String, nullable=True)
+    feature = Column(String, nullable=True)
+    type = Column(String, nullable=True)
+
+
+class UsageBucket(Base):
+    # Consumed amount and number of usage events per subject and hour or day, aggregated from usage_event
+    __tablename__ = 'usage_bucket'
+    __table_args__ = (
+        Index('ix_usage_bucket_start', 'granularity', 'start'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    granularity = Column(Enum(UsageGranularity), nullable=False)
+    start = Column(DateTime, nullable=False)  # UTC
+    user_id = Column(String, nullable=False)
+    course_id = Column(String, nullable=True)
+    feature = Column(String, nullable=True)
+    type = Column(String, nullable=True)
+    amount = Column(Integer, nullable=False)
+    events = Column(Integer, nullable=False)
+
+
+# NULL-safe like QUOTA_KEY, the conflict target of the rollup upserts
+USAGE_BUCKET_KEY = (
+    UsageBucket.granularity,
+    UsageBucket.start,
+    UsageBucket.user_id,
+    func.coalesce(UsageBucket.course_id, literal_column("''")),
+    func.coalesce(UsageBucket.feature, literal_column("''")),
+    func.coalesce(UsageBucket.type, literal_column("''")),
+)
+
+Index('uq_usage_bucket_key', *USAGE_BUCKET_KEY, unique=True)
+
+
+class UsageRollup(Base):
+    # Single row with the id of the last usage event aggregated into usage_bucket
+    __tablename__ = 'usage_rollup'
+
+    id = Column(Integer, primary_key=True)
+    last_event_id = Column(Integer, nullable=False)
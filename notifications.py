@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import models
+
+QUOTA_EVENTS_KEEPALIVE = float(os.getenv("QUOTA_EVENTS_KEEPALIVE", "15"))
+QUOTA_EVENTS_MAX_LIFETIME = float(os.getenv("QUOTA_EVENTS_MAX_LIFETIME", "300"))
+QUOTA_EVENTS_RETRY = int(os.getenv("QUOTA_EVENTS_RETRY", "1000"))
+
+
+class QuotaSubscription:
+    """
+    Changed quotas not yet sent to one subscriber, keyed by quota id.
+
+    A quota changed again before it was sent only keeps its latest state, so a slow client holds at most
+    one entry per quota it subscribed to.
+    """
+
+    __slots__ = ("course_id", "user_id", "pending", "replaced", "changed")
+
+    def __init__(self, course_id: str | None, user_id: str | None):
+        self.course_id = course_id
+        self.user_id = user_id
+        self.pending: dict[int, dict] = {}
+        # All quotas were replaced, the client has to fetch them again
+        self.replaced = False
+        self.changed = asyncio.Event()
+
+    def add(self, quota_id: int, quota: dict):
+        self.pending[quota_id] = quota
+        self.changed.set()
+
+    def replace(self):
+        self.pending.clear()
+        self.replaced = True
+        self.changed.set()
+
+    async def wait(self, timeout: float) -> bool:
+        # False after timeout seconds without changes
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.changed.clear()
+        return True
+
+    def take(self) -> tuple[bool, list[dict]]:
+        replaced, self.replaced = self.replaced, False
+        pending, self.pending = self.pending, {}
+        return replaced, list(pending.values())
+
+
+class QuotaHub:
+    """
+    In-process fan-out of quota changes to subscribers of a course and/or user.
+
+    A subscriber receives the changes of every quota that applies to it: the global quotas, the quotas
+    of its course and its user, and the course member quota of both. Subscriptions are indexed by course
+    and user, so publishing a change only touches the subscribers it applies to and idle subscriptions
+    cost nothing but their entry. Changes made through other worker processes are not seen.
+    """
+
+    def __init__(self):
+        self.subscriptions: set[QuotaSubscription] = set()
+        self.by_course: dict[str, set[QuotaSubscription]] = {}
+        self.by_user: dict[str, set[QuotaSubscription]] = {}
+        self.by_member: dict[tuple[str, str], set[QuotaSubscription]] = {}
+
+    def indexes(self, subscription: QuotaSubscription) -> list[tuple[dict, object]]:
+        indexes = []
+        if subscription.course_id is not None:
+            indexes.append((self.by_course, subscription.course_id))
+        if subscription.user_id is not None:
+            indexes.append((self.by_user, subscription.user_id))
+        if subscription.course_id is not None and subscription.user_id is not None:
+            indexes.append((self.by_member, (subscription.course_id, subscription.user_id)))
+        return indexes
+
+    def subscribe(self, course_id: str = None, user_id: str = None) -> QuotaSubscription:
+        subscription = QuotaSubscription(course_id, user_id)
+        self.subscriptions.add(subscription)
+        for index, key in self.indexes(subscription):
+            index.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: QuotaSubscription):
+        self.subscriptions.discard(subscription)
+        for index, key in self.indexes(subscription):
+            subscribers = index.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del index[key]
+
+    def subscribers(self, quota: models.Quota) -> set[QuotaSubscription]:
+        if quota.course_id is not None and quota.user_id is not None:
+            return self.by_member.get((quota.course_id, quota.user_id), set())
+        if quota.course_id is not None:
+            return self.by_course.get(quota.course_id, set())
+        if quota.user_id is not None:
+            return self.by_user.get(quota.user_id, set())
+        return self.subscriptions
+
+    def publish(self, quotas: list[tuple[models.Quota, dict]]):
+        """Pass committed quotas with their serialized state to the subscribers they apply to."""
+        if not self.subscriptions:
+            return
+        for quota, serialized in quotas:
+            for subscription in self.subscribers(quota):
+                subscription.add(quota.id, serialized)
+
+    def publish_replaced(self):
+        # After a snapshot import, ids of pending changes may refer to other quotas
+        for subscription in self.subscriptions:
+            subscription.replace()
+
+
+quota_hub = QuotaHub()
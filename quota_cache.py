@@ -0,0 +1,138 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import models
+import schemas
+from coherence import QUOTAS, coherence
+
+QUOTA_CACHE_MAX_QUOTAS = int(os.getenv("QUOTA_CACHE_MAX_QUOTAS", "100000"))
+QUOTA_CACHE_TTL = float(os.getenv("QUOTA_CACHE_TTL", "30"))
+
+
+class QuotaCache:
+    """
+    Process-local read-through LRU cache of course and course member quota lookups.
+
+    Entries are keyed by course: ("course", course_id) for the course quotas, ("member", course_id,
+    user_id) for a course member quota and ("members", course_id, limit, after) for a page of course
+    member quotas. Writers of this worker invalidate the entries their quotas appear in after commit,
+    writes by other workers clear the cache through the QUOTAS coherence channel. Usage counted by other
+    workers is not published, so entries expire after ttl seconds. Beyond max_quotas cached quotas the
+    least recently used entries are dropped.
+    """
+
+    def __init__(self, max_quotas: int, ttl: float):
+        self.max_quotas = max_quotas
+        self.ttl = ttl
+        self.entries: OrderedDict[tuple, tuple[float, object, list[models.Quota]]] = OrderedDict()
+        self.size = 0
+        # Keys by course and by id of the cached quotas, for precise invalidation
+        self.by_course: dict[str, set[tuple]] = {}
+        self.by_quota: dict[int, set[tuple]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get_or_load(self, key: tuple, load: Callable[[], Awaitable]):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, value, _ = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.remove(key)
+            self.evictions += 1
+
+        self.misses += 1
+        # A value loaded while a write invalidated entries may predate the write
+        invalidations = self.invalidations
+        value = await load()
+        if self.max_quotas > 0 and invalidations == self.invalidations:
+            self.put(key, value)
+        return value
+
+    def put(self, key: tuple, value):
+        quotas = value if isinstance(value, list) else [value]
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value, quotas)
+        self.size += max(len(quotas), 1)
+        self.by_course.setdefault(key[1], set()).add(key)
+        for quota in quotas:
+            if quota.id is not None:
+                self.by_quota.setdefault(quota.id, set()).add(key)
+
+        while self.size > self.max_quotas and self.entries:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        _, _, quotas = entry
+        self.size -= max(len(quotas), 1)
+        self.discard(self.by_course, key[1], key)
+        for quota in quotas:
+            if quota.id is not None:
+                self.discard(self.by_quota, quota.id, key)
+
+    @staticmethod
+    def discard(index: dict, index_key, key: tuple):
+        keys = index.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+    def invalidate_keys(self, keys):
+        self.invalidations += 1
+        for key in list(keys):
+            self.remove(key)
+
+    def invalidate(self, quotas: list[models.Quota], limits: bool = False):
+        """
+        Drop the entries written quotas appear in, or whose inherited quotas they change.
+
+        limits tells whether limits were written, global ones are inherited by counters of every course.
+        """
+        keys = set()
+        for quota in quotas:
+            if quota.course_id is None:
+                if limits and quota.user_id is None:
+                    self.clear()
+                    return
+                # Global counters are not cached
+                continue
+            course_keys = self.by_course.get(quota.course_id, set())
+            if quota.user_id is not None:
+                keys.add(("member", quota.course_id, quota.user_id))
+                keys.update(key for key in course_keys if key[0] == "members")
+            elif quota.scope == schemas.QuotaScope.course_user:
+                # Default of all members without own quota
+                keys.update(course_keys)
+            else:
+                keys.add(("course", quota.course_id))
+        self.invalidate_keys(keys)
+
+    def invalidate_ids(self, quota_ids):
+        keys = set()
+        for quota_id in quota_ids:
+            keys.update(self.by_quota.get(quota_id, ()))
+        self.invalidate_keys(keys)
+
+    def clear(self):
+        self.invalidations += 1
+        self.entries.clear()
+        self.by_course.clear()
+        self.by_quota.clear()
+        self.size = 0
+
+
+quota_cache = QuotaCache(max_quotas=QUOTA_CACHE_MAX_QUOTAS, ttl=QUOTA_CACHE_TTL)
+# Writes of this worker invalidate precisely, the whole cache is only dropped for writes of other workers
+coherence.subscribe(QUOTAS, quota_cache.clear, local=False)
@@ -0,0 +1,86 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+import models
+
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """
+    In-memory token buckets that cap the consumption rate of quotas with a burst_limit.
+
+    A bucket holds up to burst_limit units of the quota and refills with refill_per_second units per
+    second. There is one bucket per (scope, feature, course_id, user_id) of the consuming quota, created
+    full on first use. Limits are local to the process, with several workers each of them allows the
+    full rate. The least recently used buckets are dropped beyond max_buckets, which only forgets the
+    consumption of the last burst_limit / refill_per_second seconds.
+    """
+
+    def __init__(self, max_buckets: int):
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict[tuple, TokenBucket] = OrderedDict()
+
+    def refill(self, quota_definition: models.QuotaDefinition, key: tuple, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(quota_definition.burst_limit, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(
+                quota_definition.burst_limit,
+                bucket.tokens + (now - bucket.updated) * (quota_definition.refill_per_second or 0)
+            )
+            bucket.updated = now
+        return bucket
+
+    def acquire(self, limited: list[tuple[models.QuotaDefinition, tuple]], amount: int) -> list[tuple[models.QuotaDefinition, float]]:
+        """
+        Take amount from the buckets of all (definition, key) pairs, or from none of them.
+
+        Returns the denied definitions with the seconds until their bucket holds amount again, which is
+        infinite if amount exceeds the burst limit.
+        """
+        now = time.monotonic()
+        buckets = [(quota_definition, self.refill(quota_definition, key, now)) for quota_definition, key in limited]
+
+        denied = []
+        for quota_definition, bucket in buckets:
+            if bucket.tokens < amount:
+                if amount > quota_definition.burst_limit or not quota_definition.refill_per_second:
+                    denied.append((quota_definition, math.inf))
+                else:
+                    denied.append((quota_definition, (amount - bucket.tokens) / quota_definition.refill_per_second))
+        if not denied:
+            for _, bucket in buckets:
+                bucket.tokens -= amount
+        return denied
+
+    def release(self, limited: list[tuple[models.QuotaDefinition, tuple]], amount: int):
+        # Give back what acquire took for a consumption that failed afterwards
+        for quota_definition, key in limited:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.tokens = min(quota_definition.burst_limit, bucket.tokens + amount)
+
+    def available(self, quota_definition: models.QuotaDefinition, key: tuple) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return quota_definition.burst_limit
+        elapsed = time.monotonic() - bucket.updated
+        return min(quota_definition.burst_limit, bucket.tokens + elapsed * (quota_definition.refill_per_second or 0))
+
+
+rate_limiter = RateLimiter(max_buckets=RATE_LIMIT_MAX_BUCKETS)
@@ -0,0 +1,45 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from coherence import DEFINITIONS, coherence
+from schemas import ResetIntervalDefinition
+
+
+class QuotaDefinitionRegistry:
+    """
+    Process-local cache of all quota definitions, keyed by (scope, feature).
+
+    Definitions only change through seeding or administration, so they are loaded once and served from
+    memory afterwards. Whoever changes the quota_definition table has to publish to the DEFINITIONS
+    coherence channel, which invalidates the registry of every worker; the next access then reloads
+    the definitions.
+    """
+
+    def __init__(self):
+        self.definitions: dict | None = None
+        # Incremented on every load, lets dependent caches detect changed definitions
+        self.generation = 0
+        # Reset interval and definition by id, kept across invalidations for synchronous lookups
+        self.reset_intervals: dict[int, ResetIntervalDefinition | None] = {}
+        self.by_id: dict[int, models.QuotaDefinition] = {}
+
+    async def load(self, db: AsyncSession) -> dict:
+        result = await db.scalars(select(models.QuotaDefinition).order_by(models.QuotaDefinition.id))
+        self.definitions = {(d.scope, d.feature): d for d in result}
+        self.reset_intervals = {d.id: d.reset_interval for d in self.definitions.values()}
+        self.by_id = {d.id: d for d in self.definitions.values()}
+        self.generation += 1
+        return self.definitions
+
+    def invalidate(self):
+        self.definitions = None
+
+    async def get_all(self, db: AsyncSession) -> dict:
+        if self.definitions is None:
+            return await self.load(db)
+        return self.definitions
+
+
+definitions = QuotaDefinitionRegistry()
+coherence.subscribe(DEFINITIONS, definitions.invalidate)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import case, func, literal_column, select, update
+
+import models
+from coherence import next_quota_revision
+from database import SessionLocal
+from registry import definitions
+from schemas import ResetIntervalDefinition
+
+RESET_TIMEZONE = ZoneInfo(os.getenv("RESET_TIMEZONE", "UTC"))
+RESET_CHUNK_SIZE = int(os.getenv("RESET_CHUNK_SIZE", "1000"))
+RESET_SCHEDULER = os.getenv("RESET_SCHEDULER", "true").lower() == "true"
+
+
+def current_period(reset_interval: ResetIntervalDefinition | None, now: datetime = None) -> str | None:
+    """
+    Marker of the period usage is currently counted in, None if the usage is never reset.
+
+    Semesters follow the German academic calendar: the summer semester runs from April to September,
+    the winter semester from October to March.
+    """
+    if reset_interval is None:
+        return None
+
+    now = now or datetime.now(RESET_TIMEZONE)
+    if reset_interval == ResetIntervalDefinition.daily:
+        return now.strftime("%Y-%m-%d")
+    if reset_interval == ResetIntervalDefinition.weekly:
+        year, week, _ = now.isocalendar()
+        return f"{year}-W{week:02d}"
+    if reset_interval == ResetIntervalDefinition.monthly:
+        return now.strftime("%Y-%m")
+    if 4 <= now.month <= 9:
+        return f"{now.year}-SS"
+    return f"{now.year if now.month >= 10 else now.year - 1}-WS"
+
+
+def quota_period(quota_definition_id: int) -> str | None:
+    return current_period(definitions.reset_intervals.get(quota_definition_id))
+
+
+def current_used(quota: models.Quota) -> int | None:
+    # Usage stored for an earlier period was reset, even if the scheduler did not get to the row yet
+    if quota.used and (quota.period or None) != quota_period(quota.quota_definition_id):
+        return 0
+    return quota.used
+
+
+def period_case(quota_definition_ids) -> case:
+    # Current period of each row by its quota definition, for statements over rows of several definitions
+    return case(
+        {quota_definition_id: quota_period(quota_definition_id) for quota_definition_id in quota_definition_ids},
+        value=models.Quota.quota_definition_id,
+        else_=None
+    )
+
+
+def add_usage(used, period, new_period, amount):
+    # used + amount within the same period, a new period starts from amount
+    return case(
+        (func.coalesce(period, literal_column("''")) == func.coalesce(new_period, literal_column("''")),
+         func.coalesce(used, 0) + amount),
+        else_=amount
+    )
+
+
+async def reset_expired_quotas(stopping: asyncio.Event = None):
+    """
+    Zero the usage of all quotas whose period has ended.
+
+    Rows are walked by id in chunks of RESET_CHUNK_SIZE, each in its own short transaction, so a reset
+    of millions of rows never holds the write lock for long. Reads do not depend on it, see current_used.
+    Returns early after the current chunk once stopping is set.
+    """
+    async with SessionLocal() as db:
+        quota_definitions = list((await definitions.get_all(db)).values())
+
+    for quota_definition in quota_definitions:
+        period = current_period(quota_definition.reset_interval)
+        if period is None:
+            continue
+
+        reset = 0
+        last_id = 0
+        while not (stopping and stopping.is_set()):
+            async with SessionLocal() as db:
+                # Only expired rows, a day without expired usage takes a single query per definition
+                expired = (
+                    func.coalesce(models.Quota.used, 0) != 0,
+                    func.coalesce(models.Quota.period, literal_column("''")) != period
+                )
+                ids = (await db.scalars(
+                    select(models.Quota.id).where(
+                        models.Quota.quota_definition_id == quota_definition.id,
+                        models.Quota.id > last_id,
+                        *expired
+                    ).order_by(models.Quota.id).limit(RESET_CHUNK_SIZE)
+                )).all()
+                if not ids:
+                    break
+                last_id = ids[-1]
+
+                revision = await next_quota_revision(db)
+                # Checked again, a consumption may have started the new period in between
+                result = await db.execute(
+                    update(models.Quota).where(models.Quota.id.in_(ids), *expired).values(used=0, period=period, revision=revision).execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    await db.commit()
+                    reset += result.rowcount
+                else:
+                    # Nothing changed, keep the revision
+                    await db.rollback()
+            # Let requests waiting for the write lock in between
+            await asyncio.sleep(0)
+
+        if reset:
+            logging.info(f"Reset usage of {reset} quotas of definition {quota_definition.id} for period {period}")
+
+
+def seconds_until_next_period(now: datetime = None) -> float:
+    # All reset intervals start at midnight
+    now = now or datetime.now(RESET_TIMEZONE)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+
+async def run_reset_scheduler(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await reset_expired_quotas(stopping)
+        except Exception as e:
+            logging.error(f"Resetting quotas failed: {e}")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=seconds_until_next_period() + 1)
+        except asyncio.TimeoutError:
+            pass
@@ -1,4 +1,5 @@
 import enum
+from datetime import datetime
 
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
@@ -11,6 +12,11 @@ class ResetIntervalDefinition(enum.Enum):
     semester = "semester"
 
 
+class UsageGranularity(enum.Enum):
+    hour = "hour"
+    day = "day"
+
+
 # Enum definitions
 class QuotaScope(enum.Enum):
     user = "user"
@@ -25,6 +31,15 @@ class QuotaDefinition(BaseModel):
     reset_interval: Optional[ResetIntervalDefinition]
     scope: QuotaScope
     feature: Optional[str] = None
+    burst_limit: Optional[int] = None
+    refill_per_second: Optional[float] = None
+
+
+class RateLimitState(BaseModel):
+    burst_limit: int
+    refill_per_second: Optional[float] = None
+    # Amount that can be consumed right now, only reported for quotas that count consumption
+    available: Optional[int] = None
 
 
 class QuotaGet(BaseModel):
@@ -34,6 +49,7 @@ class QuotaGet(BaseModel):
     scope: QuotaScope
     feature: Optional[str] = None
     user_id: Optional[str] = None
+    rate_limit: Optional[RateLimitState] = None
 
 
 class QuotaUpdate(BaseModel):
@@ -42,6 +58,56 @@ class QuotaUpdate(BaseModel):
     feature: Optional[str] = None
 
 
+class CourseQuotaQuery(BaseModel):
+    course_ids: List[str] = Field(min_length=1)
+    # Members whose course-user quotas are included, stored or inherited
+    user_ids: Optional[List[str]] = None
+
+
+class QuotaSubject(BaseModel):
+    user_id: str
+    course_id: Optional[str] = None
+    feature: Optional[str] = None
+    type: Optional[str] = None
+
+
+class QuotaConsume(QuotaSubject):
+    amount: int = Field(gt=0)
+
+
+class EffectiveQuota(BaseModel):
+    limit: int
+    used: int
+    remaining: int
+    type: Optional[str]
+    scope: QuotaScope
+    feature: Optional[str] = None
+    rate_limit: Optional[RateLimitState] = None
+
+
+class QuotaResolution(BaseModel):
+    # Smallest remaining amount across all scopes, None if no quota applies
+    remaining: Optional[int] = None
+    quotas: List[EffectiveQuota]
+
+
+class UsageQuery(BaseModel):
+    granularity: UsageGranularity = UsageGranularity.day
+    # UTC, start inclusive and end exclusive
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    user_id: Optional[str] = None
+    course_id: Optional[str] = None
+    feature: Optional[str] = None
+    type: Optional[str] = None
+
+
+class UsageBucket(BaseModel):
+    start: datetime
+    amount: int
+    events: int
+
+
 class Metadata(BaseModel):
     tool_url: str
     quota_url: str
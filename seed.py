@@ -1,12 +1,15 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from models import QuotaDefinition, Quota
+from coherence import DEFINITIONS, coherence
+from reset import current_period
 from schemas import ResetIntervalDefinition, QuotaScope
 
 
-def seed_data(db: Session):
+async def seed_data(db: AsyncSession):
     # Check whether data already exists to avoid duplicate entries
-    if db.query(QuotaDefinition).first() or db.query(Quota).first():
+    if await db.scalar(select(QuotaDefinition).limit(1)) or await db.scalar(select(Quota).limit(1)):
         return
 
     # Creating mock data for QuotaDefinition
@@ -29,6 +32,9 @@ def seed_data(db: Session):
             reset_interval=ResetIntervalDefinition.monthly,
             scope=QuotaScope.user,
             feature='gpt-3',
+            # At most 2000 tokens at once, refilled with 20 tokens per second
+            burst_limit=2000,
+            refill_per_second=20,
         ),
         QuotaDefinition(
             type='number',
@@ -62,9 +68,9 @@ def seed_data(db: Session):
 
     # Adding QuotaDefinition mock data to the session
     db.add_all(quota_definitions)
-    db.flush()  # ensures that IDs are generated for foreign key assignments
+    await db.flush()  # ensures that IDs are generated for foreign key assignments
 
-    # Create mock data for quota
+    # Create mock data for quota, the counters of user-456 inherit their limits
     quotas = [
         Quota(
             limit=1000,
@@ -73,7 +79,6 @@ def seed_data(db: Session):
             quota_definition_id=quota_definitions[0].id  # refers to the actual ID of the QuotaDefinition entry
         ),
         Quota(
-            limit=1000,
             used=200,
             type='token',
             scope=QuotaScope.user,
@@ -89,7 +94,6 @@ def seed_data(db: Session):
             quota_definition_id=quota_definitions[1].id  # refers to the actual ID of the QuotaDefinition entry
         ),
         Quota(
-            limit=1000,
             used=100,
             type='token',
             scope=QuotaScope.user,
@@ -120,7 +124,6 @@ def seed_data(db: Session):
             quota_definition_id=quota_definitions[3].id  # refers to the actual ID of the QuotaDefinition entry
         ),
         Quota(
-            limit=100,
             used=200,
             type='token',
             scope=QuotaScope.course_user,
@@ -137,6 +140,12 @@ def seed_data(db: Session):
         ),
     ]
 
+    # Usage of the mock data belongs to the current period
+    for quota in quotas:
+        quota_definition = next(d for d in quota_definitions if d.id == quota.quota_definition_id)
+        quota.period = current_period(quota_definition.reset_interval)
+
     # Adding quota mock data to the session
     db.add_all(quotas)
-    db.commit()
+    await coherence.publish(db, DEFINITIONS)
+    await db.commit()
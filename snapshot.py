@@ -0,0 +1,220 @@
+"""
+Export and import of all quota definitions and quotas as gzip-compressed NDJSON.
+
+    python snapshot.py export quota-snapshot.ndjson.gz
+    python snapshot.py import quota-snapshot.ndjson.gz
+
+The first line of a snapshot is a header with the format, schema version and the tables it holds. Each
+table starts with a line naming it and its columns, followed by one JSON array of values per row.
+"""
+import argparse
+import asyncio
+import enum
+import logging
+import zlib
+from typing import AsyncIterator
+
+import orjson
+from fastapi import HTTPException
+from sqlalchemy import delete, insert, select, text, update
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+from coherence import DEFINITIONS, QUOTAS, coherence, next_quota_revision
+from database import SessionLocal, dialect_insert, engine
+from migrations import SCHEMA_VERSION
+from quota_cache import quota_cache
+
+SNAPSHOT_FORMAT = 1
+# Referenced tables first
+SNAPSHOT_TABLES = [models.QuotaDefinition.__table__, models.Quota.__table__]
+CHUNK_SIZE = 10000
+
+
+def dump_value(value):
+    # Enum columns store the member names
+    return value.name if isinstance(value, enum.Enum) else value
+
+
+def dump_line(line) -> bytes:
+    return orjson.dumps(line) + b"\n"
+
+
+async def export_snapshot(db: AsyncSession) -> AsyncIterator[bytes]:
+    """Stream the snapshot as gzip-compressed chunks, read in one transaction from server-side cursors."""
+    compressor = zlib.compressobj(wbits=31)
+    yield compressor.compress(dump_line({
+        "snapshot": SNAPSHOT_FORMAT,
+        "schema_version": SCHEMA_VERSION,
+        "tables": [table.name for table in SNAPSHOT_TABLES]
+    }))
+
+    for table in SNAPSHOT_TABLES:
+        columns = [column.name for column in table.columns]
+        yield compressor.compress(dump_line({"table": table.name, "columns": columns}))
+
+        result = await db.stream(select(table).order_by(table.c.id).execution_options(yield_per=CHUNK_SIZE))
+        async for rows in result.partitions():
+            chunk = b"".join(dump_line([dump_value(value) for value in row]) for row in rows)
+            yield compressor.compress(chunk)
+
+    yield compressor.flush()
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    decompressor = zlib.decompressobj(wbits=31)
+    rest = b""
+    try:
+        async for chunk in chunks:
+            lines = (rest + decompressor.decompress(chunk)).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        rest += decompressor.flush()
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Snapshot is not gzip-compressed")
+    if rest:
+        yield rest
+
+
+async def import_snapshot(db: AsyncSession, chunks: AsyncIterator[bytes]) -> dict[str, int]:
+    """
+    Replace the quota definitions and/or quotas with the snapshot, in one transaction.
+
+    Only the tables listed in the header are replaced. Rows are inserted with multi-row inserts of
+    CHUNK_SIZE rows. Returns the number of imported rows per table.
+    """
+    tables = {table.name: table for table in SNAPSHOT_TABLES}
+    counts = {}
+    table = columns = None
+    rows = []
+    # Ids of the rows of tables updated in place
+    imported_ids: dict[str, set] = {}
+
+    async def insert_rows():
+        if not rows:
+            return
+        values = [dict(zip(columns, row)) for row in rows]
+        if table.name in imported_ids:
+            stmt = dialect_insert(db, table)
+            await db.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column: stmt.excluded[column] for column in columns if column != "id"}
+            ), values)
+            imported_ids[table.name].update(row["id"] for row in values)
+        else:
+            await db.execute(insert(table), values)
+        counts[table.name] += len(rows)
+        rows.clear()
+
+    lines = read_lines(chunks)
+    try:
+        header = orjson.loads(await anext(lines, b"{}"))
+        if not isinstance(header, dict) or header.get("snapshot") != SNAPSHOT_FORMAT:
+            raise HTTPException(status_code=400, detail="Unsupported snapshot format")
+        # Columns and their meaning change between schema versions
+        if header.get("schema_version") != SCHEMA_VERSION:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Snapshot of schema version {header.get('schema_version')}, expected {SCHEMA_VERSION}"
+            )
+        snapshot_tables = header.get("tables")
+        if not isinstance(snapshot_tables, list) or not snapshot_tables or not set(snapshot_tables) <= tables.keys():
+            raise HTTPException(status_code=400, detail=f"Unknown tables in snapshot: {snapshot_tables}")
+
+        # Definitions referenced by quotas that are kept cannot be deleted first, they are updated in place
+        # and the ones missing from the snapshot deleted afterwards
+        if models.Quota.__tablename__ not in snapshot_tables:
+            imported_ids[models.QuotaDefinition.__tablename__] = set()
+        # Quotas reference the definitions
+        for table_to_clear in reversed(SNAPSHOT_TABLES):
+            if table_to_clear.name in snapshot_tables and table_to_clear.name not in imported_ids:
+                await db.execute(delete(table_to_clear))
+
+        async for line in lines:
+            if not line:
+                continue
+            values = orjson.loads(line)
+            if isinstance(values, dict):
+                await insert_rows()
+                table = tables.get(values.get("table"))
+                if table is None or table.name not in snapshot_tables or table.name in counts or \
+                        not set(values["columns"]) <= set(table.columns.keys()) or \
+                        (table.name in imported_ids and "id" not in values["columns"]):
+                    raise HTTPException(status_code=400, detail=f"Unknown table or columns in snapshot: {values}")
+                columns = values["columns"]
+                counts[table.name] = 0
+                continue
+            if table is None:
+                raise HTTPException(status_code=400, detail="Snapshot row before table header")
+            # zip() would silently drop or leave out values
+            if not isinstance(values, list) or len(values) != len(columns):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Row of {table.name} does not have the {len(columns)} values of its columns: {values}"
+                )
+            rows.append(values)
+            if len(rows) >= CHUNK_SIZE:
+                await insert_rows()
+        await insert_rows()
+        # Fails on definitions still referenced by quotas
+        for table_name, ids in imported_ids.items():
+            await db.execute(delete(tables[table_name]).where(tables[table_name].c.id.not_in(ids)))
+
+        if db.bind.dialect.name == "postgresql":
+            # Explicit ids do not advance the sequences of new rows
+            for snapshot_table in SNAPSHOT_TABLES:
+                await db.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{snapshot_table.name}', 'id'), "
+                    f"coalesce((SELECT max(id) FROM {snapshot_table.name}), 0) + 1, false)"
+                ))
+
+        # All quotas changed for clients syncing changes since an earlier revision
+        revision = await next_quota_revision(db)
+        await db.execute(update(models.Quota).values(revision=revision))
+
+        await coherence.publish(db, DEFINITIONS)
+        await coherence.publish(db, QUOTAS)
+        await db.commit()
+        quota_cache.clear()
+    except (ValueError, KeyError, TypeError) as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot: {e}")
+    except (IntegrityError, DataError) as e:
+        # Rows the database rejects, e.g. duplicate keys or values of the wrong type
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot: {e.orig}")
+    except Exception:
+        await db.rollback()
+        raise
+    return counts
+
+
+async def read_file(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            yield chunk
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Export or import a snapshot of all quota definitions and quotas")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("file", help="Snapshot file, gzip-compressed NDJSON")
+    args = parser.parse_args()
+
+    async with SessionLocal() as db:
+        if args.command == "export":
+            with open(args.file, "wb") as f:
+                async for chunk in export_snapshot(db):
+                    f.write(chunk)
+            logging.info(f"Exported snapshot to {args.file}")
+        else:
+            counts = await import_snapshot(db, read_file(args.file))
+            logging.info(f"Imported {counts} rows from {args.file}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix="quota-tests-")
+
+# The modules read their configuration on import, so it is set before the app is imported
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DATA_DIR}/quota.db"
+os.environ["API_KEY"] = "test-api-key"
+os.environ["RESET_SCHEDULER"] = "false"
+os.environ["USAGE_BUFFER"] = "false"
+os.environ["USAGE_EVENTS"] = "false"
+sys.path.insert(0, ROOT)
+# Static files are mounted relative to the working directory
+os.chdir(ROOT)
+
+API_HEADERS = {"Authorization": "Bearer test-api-key"}
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    import main
+
+    # One client for all tests, the background tasks of the app are bound to its event loop
+    with TestClient(main.app) as client:
+        yield client
+
+
+def consume(client, amount: int, user_id: str, course_id: str = None, **consumption):
+    return client.post("/quota/consume", headers=API_HEADERS, json={
+        "amount": amount, "type": "token", "user_id": user_id, "course_id": course_id, **consumption
+    })
+
+
+class SlowCommitSession(AsyncSession):
+    async def commit(self):
+        await asyncio.sleep(0.5)
+        await super().commit()
+
+
+def slow_commit_sessions() -> async_sessionmaker:
+    # Replaces the SessionLocal of a module, to observe a flush while its transaction commits
+    from database import engine
+
+    return async_sessionmaker(bind=engine, class_=SlowCommitSession, expire_on_commit=False)
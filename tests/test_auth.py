@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import utils
+
+
+def test_verification_keys_are_loaded_on_startup(client):
+    assert utils.load_verification_keys.cache_info().currsize == 1
+
+
+def test_unreadable_key_file_fails(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(utils, "SUPPORTED_ALGORITHMS", ["RS256"])
+    monkeypatch.setenv("RS256_PUBLIC_KEY_FILE", str(tmp_path / "missing.pem"))
+    utils.load_verification_keys.cache_clear()
+    try:
+        with pytest.raises(FileNotFoundError):
+            utils.load_verification_keys()
+    finally:
+        monkeypatch.undo()
+        utils.load_verification_keys.cache_clear()
+        utils.load_verification_keys()
+
+
+def create_token(sub: str, lifetime: int = 30, key: str = utils.SECRET_KEY, algorithm: str = "HS256") -> str:
+    from jose import jwt
+
+    now = int(time.time())
+    return jwt.encode({
+        "sub": sub,
+        "name": "Test User",
+        "iat": now + lifetime - 30,
+        "exp": now + lifetime,
+        "context": "course-123",
+        "context-role": "learner"
+    }, key, algorithm=algorithm)
+
+
+def test_repeated_token_is_not_decoded_again(client, monkeypatch):
+    from jose import jwt
+
+    decoded = []
+    decode = jwt.decode
+    monkeypatch.setattr(jwt, "decode", lambda *args, **kwargs: decoded.append(args) or decode(*args, **kwargs))
+
+    token = create_token("cached-user")
+    assert utils.verify_token(token).sub == "cached-user"
+    assert utils.verify_token(token).sub == "cached-user"
+    assert len(decoded) == 1
+
+
+def test_cached_token_is_rejected_after_it_expired(client):
+    token = create_token("expiring-user", lifetime=1)
+    payload = utils.verify_token(token)
+
+    # jose still accepts a token in the second of its exp
+    time.sleep(max(payload.exp + 1 - time.time(), 0) + 0.05)
+    with pytest.raises(HTTPException) as e:
+        utils.verify_token(token)
+    assert e.value.status_code == 403
+
+
+def test_token_of_algorithm_without_key_is_rejected(client):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    # RS256 is supported, but no RS256_PUBLIC_KEY_FILE is configured
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    token = create_token("rsa-user", key=private_key, algorithm="RS256")
+
+    with pytest.raises(HTTPException) as e:
+        utils.verify_token(token)
+    assert e.value.status_code == 403
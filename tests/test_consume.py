@@ -0,0 +1,19 @@
+from conftest import API_HEADERS, consume
+
+
+def test_consumption_without_type_of_several_types_is_rejected(client):
+    types = {q.get("type") for q in client.get("/quota", headers=API_HEADERS).json()}
+    assert len(types) > 1
+
+    subject = {"user_id": "typeless-user", "course_id": "typeless-course"}
+    effective = client.get("/quota/effective", headers=API_HEADERS, params=subject).json()
+    response = consume(client, 1, type=None, **subject)
+    assert response.status_code == 422
+    # Nothing was counted
+    assert client.get("/quota/effective", headers=API_HEADERS, params=subject).json() == effective
+
+
+def test_consumption_counts_only_quotas_of_its_type(client):
+    response = consume(client, 1, "typed-user")
+    assert response.status_code == 200
+    assert {q["type"] for q in response.json()} == {"token"}
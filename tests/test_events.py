@@ -0,0 +1,15 @@
+import main
+
+from conftest import API_HEADERS
+
+
+def test_stream_ends_after_its_lifetime_with_a_retry_delay(client, monkeypatch):
+    monkeypatch.setattr(main, "QUOTA_EVENTS_MAX_LIFETIME", 0.2)
+    monkeypatch.setattr(main, "QUOTA_EVENTS_KEEPALIVE", 0.05)
+
+    with client.stream("GET", "/quota/events?course_id=events-course", headers=API_HEADERS) as response:
+        assert response.status_code == 200
+        body = response.read()
+
+    assert body.startswith(f"retry: {main.QUOTA_EVENTS_RETRY}\n: subscribed\n\n".encode())
+    assert b": keepalive\n\n" in body
@@ -0,0 +1,49 @@
+from conftest import API_HEADERS, consume
+
+
+def member_limit(client, course_id: str, user_id: str) -> int:
+    response = client.get(f"/quota/course/{course_id}/user/{user_id}", headers=API_HEADERS)
+    assert response.status_code == 200
+    return response.json()["limit"]
+
+
+def test_member_counter_follows_course_default(client):
+    course_id = "inherit-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 10, "scope": "course-user"}])
+    assert consume(client, 5, "inherit-u1", course_id).status_code == 200
+    assert consume(client, 10, "inherit-u1", course_id).status_code == 429
+
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 500, "scope": "course-user"}])
+    assert member_limit(client, course_id, "inherit-u1") == 500
+    assert consume(client, 10, "inherit-u1", course_id).status_code == 200
+
+
+def test_member_override_is_kept(client):
+    course_id = "override-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 10, "scope": "course-user"}])
+    client.put(f"/quota/course/{course_id}/user/override-u1", headers=API_HEADERS,
+               json=[{"limit": 3, "scope": "course-user"}])
+    assert consume(client, 2, "override-u1", course_id).status_code == 200
+
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 500, "scope": "course-user"}])
+    assert member_limit(client, course_id, "override-u1") == 3
+    assert consume(client, 2, "override-u1", course_id).status_code == 429
+
+
+def test_user_counter_follows_global_default(client):
+    global_limits = {q["scope"]: q["limit"] for q in client.get("/quota", headers=API_HEADERS).json()
+                     if "feature" not in q}
+    assert consume(client, 1, "inherit-global-user").status_code == 200
+    try:
+        client.put("/quota", headers=API_HEADERS, json=[{"limit": 1, "scope": "user"}])
+        response = consume(client, 1, "inherit-global-user")
+        assert response.status_code == 429
+        assert "user" in response.json()["detail"]
+    finally:
+        client.put("/quota", headers=API_HEADERS, json=[{"limit": global_limits["user"], "scope": "user"}])
+
+
+def test_member_without_counter_inherits_course_default(client):
+    course_id = "inherit-new-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 42, "scope": "course-user"}])
+    assert member_limit(client, course_id, "inherit-new-user") == 42
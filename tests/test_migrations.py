@@ -0,0 +1,25 @@
+import pytest
+from sqlalchemy import update
+
+import migrations
+import models
+from database import SessionLocal
+
+
+async def set_schema_version(version: int):
+    async with SessionLocal() as db:
+        await db.execute(update(models.SchemaVersion).values(version=version))
+        await db.commit()
+
+
+def test_current_database_is_not_prepared_again(client):
+    assert client.portal.call(migrations.prepare_database) is False
+
+
+def test_newer_database_is_refused(client):
+    client.portal.call(set_schema_version, migrations.SCHEMA_VERSION + 1)
+    try:
+        with pytest.raises(RuntimeError, match="newer"):
+            client.portal.call(migrations.prepare_database)
+    finally:
+        client.portal.call(set_schema_version, migrations.SCHEMA_VERSION)
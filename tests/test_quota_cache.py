@@ -0,0 +1,91 @@
+from quota_cache import quota_cache
+from usage_buffer import usage_buffer
+
+from conftest import API_HEADERS, consume
+
+
+def fill(client, course_id: str, *user_ids: str) -> set[tuple]:
+    # Load the course, a page of its members and single members into the cache
+    client.get(f"/quota/course/{course_id}", headers=API_HEADERS)
+    client.get(f"/quota/course/{course_id}/user?limit=10", headers=API_HEADERS)
+    for user_id in user_ids:
+        client.get(f"/quota/course/{course_id}/user/{user_id}", headers=API_HEADERS)
+    return cached(course_id)
+
+
+def cached(course_id: str) -> set[tuple]:
+    return {key for key in quota_cache.entries if key[1] == course_id}
+
+
+def test_course_limit_write_drops_only_the_course_entry(client):
+    course_id = "cache-course"
+    assert fill(client, course_id, "cache-member") == {
+        ("course", course_id), ("members", course_id, 10, None), ("member", course_id, "cache-member")
+    }
+
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 50, "scope": "course"}])
+    assert cached(course_id) == {("members", course_id, 10, None), ("member", course_id, "cache-member")}
+
+
+def test_course_user_default_write_drops_all_entries_of_the_course(client):
+    course_id = "cache-default-course"
+    assert fill(client, course_id, "cache-member")
+    other = fill(client, "cache-other-course")
+
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 50, "scope": "course-user"}])
+    assert cached(course_id) == set()
+    assert cached("cache-other-course") == other
+
+
+def test_member_write_and_consumption_drop_the_member_entries(client):
+    course_id = "cache-member-course"
+    fill(client, course_id, "cache-member", "cache-other-member")
+
+    client.put(f"/quota/course/{course_id}/user/cache-member", headers=API_HEADERS,
+               json=[{"limit": 50, "scope": "course-user"}])
+    assert cached(course_id) == {("course", course_id), ("member", course_id, "cache-other-member")}
+
+    fill(client, course_id, "cache-member")
+    assert consume(client, 1, "cache-other-member", course_id).status_code == 200
+    assert ("member", course_id, "cache-other-member") not in cached(course_id)
+    assert ("members", course_id, 10, None) not in cached(course_id)
+    assert ("member", course_id, "cache-member") in cached(course_id)
+
+
+def test_global_limit_write_clears_the_cache(client):
+    fill(client, "cache-global-course", "cache-member")
+    limit = next(q for q in client.get("/quota", headers=API_HEADERS).json() if q["scope"] == "course")["limit"]
+
+    # Inherited by the course counters of every course
+    client.put("/quota", headers=API_HEADERS, json=[{"limit": limit, "scope": "course"}])
+    assert not quota_cache.entries
+
+
+def test_flush_drops_the_entries_holding_flushed_quotas(client, monkeypatch):
+    course_id = "cache-flush-course"
+    monkeypatch.setattr(usage_buffer, "enabled", True)
+    assert consume(client, 1, "cache-member", course_id).status_code == 200
+    client.portal.call(usage_buffer.flush)
+
+    assert consume(client, 1, "cache-member", course_id).status_code == 200
+    fill(client, course_id, "cache-member", "cache-other-member")
+    client.portal.call(usage_buffer.flush)
+    # Only the inherited quota of the other member holds none of the flushed rows
+    assert cached(course_id) == {("member", course_id, "cache-other-member")}
+
+
+def test_load_racing_an_invalidation_is_not_stored(client):
+    key = ("course", "cache-race-course")
+
+    async def load_during_write():
+        async def load():
+            # A write of this worker commits while the load waits for the database
+            quota_cache.invalidate_keys([("course", "cache-other-course")])
+            return []
+        return await quota_cache.get_or_load(key, load)
+
+    client.portal.call(load_during_write)
+    assert key not in quota_cache.entries
+
+    client.get("/quota/course/cache-race-course", headers=API_HEADERS)
+    assert key in quota_cache.entries
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limit
+from registry import definitions
+from schemas import QuotaScope
+
+from conftest import API_HEADERS, consume
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Buckets refill only when the test advances the clock
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def small_burst(client, monkeypatch):
+    quota_definition = next(
+        d for d in definitions.by_id.values() if d.scope == QuotaScope.user and d.feature == "gpt-3"
+    )
+    monkeypatch.setattr(quota_definition, "burst_limit", 10)
+    monkeypatch.setattr(quota_definition, "refill_per_second", 2)
+
+
+def gpt3_quota(quotas: list[dict]) -> dict:
+    return next(q for q in quotas if q.get("feature") == "gpt-3")
+
+
+def effective(client, user_id: str) -> dict:
+    return client.get("/quota/effective", headers=API_HEADERS, params={"user_id": user_id, "feature": "gpt-3"}).json()
+
+
+def test_burst_is_denied_until_the_bucket_refills(client, clock, small_burst):
+    user_id = "rate-burst-user"
+    assert consume(client, 10, user_id, feature="gpt-3").status_code == 200
+
+    response = consume(client, 4, user_id, feature="gpt-3")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    # The denied consumption was not counted
+    assert gpt3_quota(effective(client, user_id)["quotas"])["used"] == 10
+
+    clock.now += 1
+    assert consume(client, 4, user_id, feature="gpt-3").status_code == 429
+    clock.now += 1
+    assert consume(client, 4, user_id, feature="gpt-3").status_code == 200
+
+
+def test_amount_above_burst_limit_is_denied_without_retry_after(client, clock, small_burst):
+    response = consume(client, 11, "rate-above-user", feature="gpt-3")
+    assert response.status_code == 429
+    assert "Retry-After" not in response.headers
+    # Nothing was taken from the bucket
+    assert gpt3_quota(effective(client, "rate-above-user")["quotas"])["rate_limit"]["available"] == 10
+
+
+def test_tokens_are_given_back_when_the_quota_is_exceeded(client, clock):
+    user_id = "rate-release-user"
+    response = consume(client, 600, user_id, feature="gpt-3")
+    assert response.status_code == 200
+    assert gpt3_quota(response.json())["rate_limit"]["available"] == 1400
+
+    # Within the burst limit, but above the quota limit of 1000
+    response = consume(client, 600, user_id, feature="gpt-3")
+    assert response.status_code == 429
+    assert "Retry-After" not in response.headers
+    assert gpt3_quota(effective(client, user_id)["quotas"])["rate_limit"] == {
+        "burst_limit": 2000, "refill_per_second": 20, "available": 1400
+    }
+
+    clock.now += 10
+    assert gpt3_quota(effective(client, user_id)["quotas"])["rate_limit"]["available"] == 1600
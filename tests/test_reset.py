@@ -0,0 +1,108 @@
+import pytest
+from sqlalchemy import select
+
+import models
+import reset
+from database import AsyncSession, engine
+from quota_cache import quota_cache
+from reset import reset_expired_quotas
+from usage_buffer import usage_buffer
+
+from conftest import API_HEADERS, consume
+
+
+@pytest.fixture
+def next_period(monkeypatch):
+    real_current_period = reset.current_period
+
+    def current_period(reset_interval, now=None):
+        period = real_current_period(reset_interval, now)
+        return period and period + "-next"
+
+    def switch():
+        monkeypatch.setattr(reset, "current_period", current_period)
+
+    yield switch
+    # Cached quotas were read in the switched period
+    quota_cache.clear()
+
+
+async def persisted_row(scope: models.QuotaScope, course_id: str, user_id: str = None) -> tuple:
+    async with AsyncSession(engine) as db:
+        return (await db.execute(select(models.Quota.used, models.Quota.period, models.Quota.revision).where(
+            models.Quota.scope == scope, models.Quota.feature == None,
+            models.Quota.course_id == course_id,
+            models.Quota.user_id == user_id if user_id else models.Quota.user_id == None
+        ))).one()
+
+
+def course_used(quotas: list[dict]) -> int:
+    return next(q["used"] for q in quotas if q["scope"] == "course")
+
+
+def test_usage_of_an_earlier_period_is_not_counted(client, next_period):
+    course_id = "period-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 100, "scope": "course"}])
+    assert consume(client, 30, "period-user", course_id).status_code == 200
+
+    next_period()
+    response = client.get(f"/quota/course/{course_id}", headers=API_HEADERS)
+    assert course_used(response.json()) == 0
+
+    # The stored row is updated in place and starts the new period from the amount
+    response = consume(client, 5, "period-user", course_id)
+    assert response.status_code == 200
+    assert course_used(response.json()) == 5
+    used, period, _ = client.portal.call(persisted_row, models.QuotaScope.course, course_id)
+    assert used == 5
+    assert period.endswith("-next")
+
+
+def test_counter_created_in_a_new_period_belongs_to_it(client, next_period):
+    course_id = "period-new-course"
+    next_period()
+    assert consume(client, 4, "period-new-user", course_id).status_code == 200
+
+    used, period, _ = client.portal.call(persisted_row, models.QuotaScope.course_user, course_id, "period-new-user")
+    assert used == 4
+    assert period.endswith("-next")
+
+
+def test_flush_of_an_earlier_period_is_dropped(client, next_period, monkeypatch):
+    course_id = "period-flush-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 100, "scope": "course"}])
+    assert consume(client, 20, "period-user", course_id).status_code == 200
+
+    monkeypatch.setattr(usage_buffer, "enabled", True)
+    assert consume(client, 7, "period-user", course_id).status_code == 200
+
+    next_period()
+    client.portal.call(reset_expired_quotas)
+    client.portal.call(usage_buffer.flush)
+
+    # The 7 were counted in the earlier period and must not show up in the new one
+    used, period, _ = client.portal.call(persisted_row, models.QuotaScope.course, course_id)
+    assert used == 0
+    assert period.endswith("-next")
+    response = client.get(f"/quota/course/{course_id}", headers=API_HEADERS)
+    assert course_used(response.json()) == 0
+
+
+def test_reset_zeroes_only_expired_quotas(client, next_period):
+    expired_course, current_course = "period-expired-course", "period-current-course"
+    for course_id in (expired_course, current_course):
+        client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 100, "scope": "course"}])
+        assert consume(client, 10, "period-user", course_id).status_code == 200
+
+    next_period()
+    assert consume(client, 5, "period-user", current_course).status_code == 200
+    current = client.portal.call(persisted_row, models.QuotaScope.course, current_course)
+
+    client.portal.call(reset_expired_quotas)
+
+    used, period, _ = client.portal.call(persisted_row, models.QuotaScope.course, expired_course)
+    assert used == 0
+    assert period.endswith("-next")
+    # Rows already counting the new period keep their usage and revision
+    assert client.portal.call(persisted_row, models.QuotaScope.course, current_course) == current
+    assert current[0] == 5
@@ -0,0 +1,61 @@
+import asyncio
+
+import usage_buffer as usage_buffer_module
+from usage_buffer import usage_buffer
+
+from conftest import API_HEADERS, consume, slow_commit_sessions
+
+
+def test_consumption_keeps_global_listing_unmodified(client):
+    response = client.get("/quota", headers=API_HEADERS)
+    etag = response.headers["ETag"]
+
+    assert consume(client, 1, "revision-user").status_code == 200
+    response = client.get("/quota", headers={**API_HEADERS, "If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_course_delta_leaves_out_members(client):
+    course_id = "revision-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 10, "scope": "course-user"}])
+    revision = client.get(f"/quota/course/{course_id}", headers=API_HEADERS).headers["X-Quota-Revision"]
+
+    client.put(f"/quota/course/{course_id}/user/revision-member", headers=API_HEADERS,
+               json=[{"limit": 3, "scope": "course-user"}])
+    response = client.get(f"/quota/course/{course_id}?since={revision}", headers=API_HEADERS)
+    assert response.status_code == 200
+    assert response.json() == []
+    assert response.headers["X-Quota-Revision"] == revision
+
+
+def test_since_beyond_revision_returns_all_quotas(client):
+    response = client.get("/quota", headers=API_HEADERS)
+    revision = int(response.headers["X-Quota-Revision"])
+
+    delta = client.get(f"/quota?since={revision + 1000}", headers=API_HEADERS)
+    assert delta.json() == response.json()
+    assert delta.headers["X-Quota-Revision"] == str(revision)
+
+
+def test_buffered_consumption_changes_only_the_etag_of_its_listing(client, monkeypatch):
+    for course_id in ("buffered-etag-course", "other-etag-course"):
+        client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 100, "scope": "course"}])
+    before = client.get("/quota/course/buffered-etag-course", headers=API_HEADERS).headers["ETag"]
+    other = client.get("/quota/course/other-etag-course", headers=API_HEADERS).headers["ETag"]
+
+    monkeypatch.setattr(usage_buffer, "enabled", True)
+    assert consume(client, 6, "buffered-etag-user", "buffered-etag-course").status_code == 200
+    pending = client.get("/quota/course/buffered-etag-course", headers=API_HEADERS).headers["ETag"]
+    assert pending != before
+    response = client.get("/quota/course/other-etag-course", headers={**API_HEADERS, "If-None-Match": other})
+    assert response.status_code == 304
+
+    monkeypatch.setattr(usage_buffer_module, "SessionLocal", slow_commit_sessions())
+    flush = client.portal.start_task_soon(usage_buffer.flush)
+    client.portal.call(asyncio.sleep, 0.1)
+    assert usage_buffer.flushing and not usage_buffer.pending
+    # The usage being flushed is neither pending nor committed
+    response = client.get("/quota/course/buffered-etag-course", headers={**API_HEADERS, "If-None-Match": before})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == pending
+    flush.result()
@@ -0,0 +1,69 @@
+from fastapi.routing import APIRoute, serialize_response
+
+import crud
+import main
+from conftest import API_HEADERS, consume
+from database import SessionLocal
+from registry import definitions
+from usage_buffer import usage_buffer
+
+
+def former_content(quota) -> dict:
+    # What routes returned for FastAPI to validate against their response_model
+    quota_definition = definitions.by_id.get(quota.quota_definition_id)
+    rate_limit = None
+    if quota_definition is not None and quota_definition.burst_limit is not None:
+        key = crud.rate_limit_key(quota_definition, quota.course_id, quota.user_id) if crud.is_consumption_counter(quota) else None
+        rate_limit = main.serialize_rate_limit(quota_definition, key)
+    return {
+        "limit": quota.effective_limit,
+        "used": usage_buffer.used(quota),
+        "type": quota.type,
+        "scope": quota.scope,
+        "feature": quota.feature,
+        "user_id": quota.user_id,
+        "rate_limit": rate_limit
+    }
+
+
+async def load_quotas() -> list:
+    async with SessionLocal() as db:
+        quotas = list(await crud.get_global_quotas(db))
+        quotas += await crud.load_course_quotas(db, "course-123")
+        quotas += await crud.load_course_member_quotas(db, "course-123")
+        return quotas
+
+
+def test_serialized_quotas_match_response_model(client):
+    # Counters of user-456 inherit their limits, and one of them has a rate limit
+    consume(client, 1, "user-456", "course-123")
+    quotas = client.portal.call(load_quotas)
+    assert {q.feature for q in quotas} > {None}
+    assert any(q.user_id is not None for q in quotas)
+
+    route = next(r for r in main.app.routes if isinstance(r, APIRoute) and r.path == "/quota")
+    expected = client.portal.call(lambda: serialize_response(
+        field=route.response_field, response_content=[former_content(q) for q in quotas],
+        exclude_none=True, dump_json=True
+    ))
+    assert main.QuotaResponse([main.serialize_quota(q) for q in quotas]).body == expected
+
+
+async def load_listings() -> list[list]:
+    async with SessionLocal() as db:
+        return [
+            await crud.get_global_quotas(db),
+            await crud.get_global_quotas(db, since=-1),
+            await crud.load_course_quotas(db, "ordered-course"),
+            await crud.load_course_quotas(db, "ordered-course", since=0),
+        ]
+
+
+def test_listings_are_ordered_by_creation(client):
+    response = client.put("/quota/course/ordered-course", headers=API_HEADERS, json=[
+        {"limit": 30, "scope": "course-user"}, {"limit": 10, "scope": "course"}
+    ])
+    assert response.status_code == 200
+    for quotas in client.portal.call(load_listings):
+        ids = [q.id for q in quotas]
+        assert len(ids) > 1 and ids == sorted(ids)
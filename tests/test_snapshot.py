@@ -0,0 +1,80 @@
+import gzip
+
+import orjson
+
+import migrations
+from conftest import API_HEADERS
+
+
+def read_snapshot(body: bytes) -> list:
+    return [orjson.loads(line) for line in gzip.decompress(body).splitlines()]
+
+
+def write_snapshot(lines: list) -> bytes:
+    return gzip.compress(b"".join(orjson.dumps(line) + b"\n" for line in lines))
+
+
+def export(client) -> list:
+    response = client.get("/snapshot", headers=API_HEADERS)
+    assert response.status_code == 200
+    return read_snapshot(response.content)
+
+
+def without_revisions(lines: list) -> list:
+    # Imports give all quotas a new revision
+    revision = None
+    stripped = []
+    for line in lines:
+        if isinstance(line, dict):
+            revision = line["columns"].index("revision") if line.get("table") == "quota" else None
+        elif revision is not None:
+            line = line[:revision] + line[revision + 1:]
+        stripped.append(line)
+    return stripped
+
+
+def test_snapshot_round_trip(client):
+    lines = export(client)
+    response = client.put("/snapshot", headers=API_HEADERS, content=write_snapshot(lines))
+    assert response.status_code == 200
+    assert sum(response.json().values()) == len([line for line in lines if isinstance(line, list)])
+    assert without_revisions(export(client)) == without_revisions(lines)
+
+
+def test_invalid_snapshots_are_rejected(client):
+    lines = export(client)
+    header, definitions_header, definition = lines[0], lines[1], lines[2]
+    invalid_snapshots = [
+        [{**header, "schema_version": migrations.SCHEMA_VERSION - 1}] + lines[1:],
+        [header, definitions_header, definition[:-1]],
+        [header, definitions_header, definition + [None]],
+        # Duplicate id
+        [header, definitions_header, definition, definition],
+        # Definitions of the quotas are missing
+        [{**header, "tables": ["quota_definition"]}, definitions_header],
+        # Table not listed in the header
+        [{**header, "tables": ["quota"]}, definitions_header, definition],
+    ]
+    for invalid_snapshot in invalid_snapshots:
+        response = client.put("/snapshot", headers=API_HEADERS, content=write_snapshot(invalid_snapshot))
+        assert response.status_code == 400, invalid_snapshot
+    assert export(client) == lines
+
+
+def test_only_tables_of_the_snapshot_are_replaced(client):
+    lines = export(client)
+    quotas_at = next(i for i, line in enumerate(lines) if i > 1 and isinstance(line, dict))
+    description = lines[1]["columns"].index("description")
+    definitions = [row[:description] + [{"en": "Updated"}] + row[description + 1:] for row in lines[2:quotas_at]]
+    definitions_only = [{**lines[0], "tables": ["quota_definition"]}, lines[1]] + definitions
+
+    # The quotas keep referencing the definitions, which are updated in place
+    response = client.put("/snapshot", headers=API_HEADERS, content=write_snapshot(definitions_only))
+    assert response.status_code == 200
+    assert response.json() == {"quota_definition": quotas_at - 2}
+    exported = export(client)
+    assert exported[2:quotas_at] == definitions
+    assert without_revisions(exported)[quotas_at:] == without_revisions(lines)[quotas_at:]
+
+    response = client.put("/snapshot", headers=API_HEADERS, content=write_snapshot(lines))
+    assert response.status_code == 200
@@ -0,0 +1,62 @@
+import asyncio
+
+from sqlalchemy import select
+
+import models
+import usage_buffer as usage_buffer_module
+from database import AsyncSession, engine
+from usage_buffer import usage_buffer
+
+from conftest import API_HEADERS, consume, slow_commit_sessions
+
+
+async def persisted_used(course_id: str) -> int:
+    async with AsyncSession(engine) as db:
+        return await db.scalar(select(models.Quota.used).where(
+            models.Quota.scope == models.QuotaScope.course, models.Quota.feature == None,
+            models.Quota.course_id == course_id, models.Quota.user_id == None
+        ))
+
+
+def test_consumption_during_slow_flush_sees_flushing_usage(client, monkeypatch):
+    course_id = "buffer-course"
+    response = client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 10, "scope": "course"}])
+    assert response.status_code == 200
+
+    monkeypatch.setattr(usage_buffer, "enabled", True)
+    assert consume(client, 6, "buffer-user", course_id).status_code == 200
+
+    monkeypatch.setattr(usage_buffer_module, "SessionLocal", slow_commit_sessions())
+    flush = client.portal.start_task_soon(usage_buffer.flush)
+    client.portal.call(asyncio.sleep, 0.1)
+    assert usage_buffer.flushing and not usage_buffer.pending
+
+    # The 6 being flushed still count against the limit of 10
+    response = consume(client, 6, "buffer-user", course_id)
+    assert response.status_code == 429
+    assert consume(client, 4, "buffer-user", course_id).status_code == 200
+
+    flush.result()
+    assert not usage_buffer.flushing
+    client.portal.call(usage_buffer.flush)
+    assert client.portal.call(persisted_used, course_id) == 10
+    assert consume(client, 1, "buffer-user", course_id).status_code == 429
+
+
+def test_stop_keeps_usage_of_interrupted_flush(client, monkeypatch):
+    course_id = "buffer-stop-course"
+    client.put(f"/quota/course/{course_id}", headers=API_HEADERS, json=[{"limit": 100, "scope": "course"}])
+    monkeypatch.setattr(usage_buffer, "enabled", True)
+    assert consume(client, 7, "buffer-user", course_id).status_code == 200
+
+    monkeypatch.setattr(usage_buffer_module, "SessionLocal", slow_commit_sessions())
+
+    async def stop_during_flush():
+        usage_buffer.start()
+        usage_buffer._wakeup.set()
+        await asyncio.sleep(0.1)
+        await usage_buffer.stop()
+
+    client.portal.call(stop_during_flush)
+    assert not usage_buffer.pending and not usage_buffer.flushing
+    assert client.portal.call(persisted_used, course_id) == 7
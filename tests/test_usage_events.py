@@ -0,0 +1,55 @@
+import asyncio
+
+from sqlalchemy import select
+
+import models
+import usage_events as usage_events_module
+from database import AsyncSession, engine
+from usage_events import usage_events, utcnow
+
+from conftest import consume, slow_commit_sessions
+
+
+async def recorded_events(user_id: str) -> list:
+    async with AsyncSession(engine) as db:
+        return list(await db.scalars(select(models.UsageEvent).where(models.UsageEvent.user_id == user_id)))
+
+
+def test_stop_keeps_events_of_interrupted_flush(client, monkeypatch):
+    monkeypatch.setattr(usage_events, "enabled", True)
+    assert consume(client, 3, "events-stop-user").status_code == 200
+    assert consume(client, 4, "events-stop-user").status_code == 200
+
+    monkeypatch.setattr(usage_events_module, "SessionLocal", slow_commit_sessions())
+
+    async def stop_during_flush():
+        usage_events.start()
+        usage_events._wakeup.set()
+        await asyncio.sleep(0.1)
+        await usage_events.stop()
+
+    client.portal.call(stop_during_flush)
+    assert not usage_events.pending
+    events = client.portal.call(recorded_events, "events-stop-user")
+    assert sorted(event.amount for event in events) == [3, 4]
+
+
+def test_events_are_stamped_when_inserted(client, monkeypatch):
+    monkeypatch.setattr(usage_events, "enabled", True)
+    assert consume(client, 1, "events-stamp-user").status_code == 200
+    client.portal.call(asyncio.sleep, 0.2)
+
+    inserted_after = utcnow()
+    client.portal.call(usage_events.flush)
+    events = client.portal.call(recorded_events, "events-stamp-user")
+    assert len(events) == 1 and events[0].created_at >= inserted_after
+
+
+def test_consumption_without_quotas_is_recorded(client, monkeypatch):
+    monkeypatch.setattr(usage_events, "enabled", True)
+    response = consume(client, 5, "events-unlimited-user", type="image")
+    assert response.status_code == 200 and response.json() == []
+
+    client.portal.call(usage_events.flush)
+    events = client.portal.call(recorded_events, "events-unlimited-user")
+    assert [(event.amount, event.type) for event in events] == [(5, "image")]
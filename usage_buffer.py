@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import String, bindparam, func, literal_column, update
+
+import models
+from coherence import next_quota_revision
+from database import SessionLocal
+from quota_cache import quota_cache
+from reset import add_usage, current_used, quota_period
+
+
+class UsageBuffer:
+    """
+    Optional write-behind accumulator for Quota.used.
+
+    Consumptions are coalesced in memory per quota id and reset period and written by a background task
+    in one batched transaction, either every flush_interval seconds or as soon as flush_threshold quotas have pending
+    usage. The buffer is local to the process: limit checks combine the persisted and the pending value,
+    but with several workers each of them only knows its own pending usage. Usage being flushed stays
+    visible until its transaction committed, flushes counts the commits so that readers can tell whether
+    rows they read may predate one. changes counts the buffered consumptions per listing, see
+    listing_changes.
+    """
+
+    def __init__(self, enabled: bool, flush_interval: float, flush_threshold: int):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending: dict[tuple[int, str | None], int] = {}
+        self.flushing: dict[tuple[int, str | None], int] = {}
+        self.flushes = 0
+        self.changes: dict[str | None, int] = {}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def add(self, quota: models.Quota, amount: int):
+        key = (quota.id, quota_period(quota.quota_definition_id))
+        self.pending[key] = self.pending.get(key, 0) + amount
+        if quota.user_id is None:
+            self.changes[quota.course_id] = self.changes.get(quota.course_id, 0) + 1
+        if len(self.pending) >= self.flush_threshold:
+            self._wakeup.set()
+
+    def listing_changes(self, course_id: str | None) -> int:
+        # Consumptions buffered for the quotas of the course listing, or the global one without course_id.
+        # Only grows, so the validators of a listing never return to those before a consumption.
+        return self.changes.get(course_id, 0)
+
+    def used(self, quota: models.Quota) -> int | None:
+        # Persisted plus pending and in-flight usage of the current period, None if the quota was never used
+        used = current_used(quota)
+        key = (quota.id, quota_period(quota.quota_definition_id))
+        pending = self.pending.get(key, 0) + self.flushing.get(key, 0)
+        if not pending:
+            return used
+        return (used or 0) + pending
+
+    async def flush(self):
+        # One flush at a time, the usage of a flush is in flushing until it committed
+        async with self._lock:
+            await self.flush_pending()
+
+    async def flush_pending(self):
+        if not self.pending:
+            return
+
+        pending = self.flushing = self.pending
+        self.pending = {}
+        quota = models.Quota.__table__
+        period = bindparam("period", type_=String)
+        try:
+            async with SessionLocal() as db:
+                revision = await next_quota_revision(db)
+                # Usage of a period the row was already reset past is dropped
+                await db.execute(
+                    update(quota)
+                    .where(
+                        quota.c.id == bindparam("quota_id"),
+                        func.coalesce(quota.c.period, literal_column("''")) <= func.coalesce(period, literal_column("''"))
+                    )
+                    .values(used=add_usage(quota.c.used, quota.c.period, period, bindparam("amount")), period=period,
+                            revision=revision),
+                    [
+                        {"quota_id": quota_id, "period": period, "amount": amount}
+                        for (quota_id, period), amount in pending.items()
+                    ]
+                )
+                await db.commit()
+                self.flushing = {}
+                self.flushes += 1
+            # Cached quotas hold the usage before the flush
+            quota_cache.invalidate_ids({quota_id for quota_id, _ in pending})
+        except BaseException:
+            # Keep the usage for the next attempt
+            self.flushing = {}
+            for key, amount in pending.items():
+                self.pending[key] = self.pending.get(key, 0) + amount
+            raise
+        logging.debug(f"Flushed usage of {len(pending)} quotas")
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Flushing usage failed: {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Not cancelled, a flush in progress has to commit or restore its usage
+        if self._task is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+usage_buffer = UsageBuffer(
+    enabled=os.getenv("USAGE_BUFFER", "false").lower() == "true",
+    flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0")),
+    flush_threshold=int(os.getenv("USAGE_FLUSH_THRESHOLD", "1000"))
+)
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert, select, update
+
+import models
+import schemas
+from database import SessionLocal, dialect_insert
+
+USAGE_ROLLUP_INTERVAL = float(os.getenv("USAGE_ROLLUP_INTERVAL", "60"))
+USAGE_ROLLUP_DELAY = float(os.getenv("USAGE_ROLLUP_DELAY", "10"))
+USAGE_ROLLUP_CHUNK_SIZE = int(os.getenv("USAGE_ROLLUP_CHUNK_SIZE", "10000"))
+
+
+def utcnow() -> datetime:
+    # Naive UTC, like the DateTime columns store it
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(created_at: datetime, granularity: schemas.UsageGranularity) -> datetime:
+    if granularity == schemas.UsageGranularity.hour:
+        return created_at.replace(minute=0, second=0, microsecond=0)
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UsageEventLog:
+    """
+    Records every consumption in the append-only usage_event table, off the request path.
+
+    Events are collected in memory and inserted by a background task in one batch, either every
+    flush_interval seconds or as soon as flush_threshold events are pending. created_at is the time of
+    the insert, not of the consumption, as the rollup relies on it to tell recently inserted events.
+    """
+
+    def __init__(self, enabled: bool, flush_interval: float, flush_threshold: int):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.pending: list[dict] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def add(self, consumption: schemas.QuotaConsume):
+        if not self.enabled:
+            return
+        self.pending.append({
+            "amount": consumption.amount,
+            "user_id": consumption.user_id,
+            "course_id": consumption.course_id,
+            "feature": consumption.feature,
+            "type": consumption.type,
+        })
+        if len(self.pending) >= self.flush_threshold:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        try:
+            async with SessionLocal() as db:
+                # Events buffered for long, e.g. while the database was down, still count as recent
+                await db.execute(insert(models.UsageEvent.__table__).values(created_at=utcnow()), pending)
+                await db.commit()
+        except BaseException:
+            # Keep the events for the next attempt
+            self.pending = pending + self.pending
+            raise
+        logging.debug(f"Recorded {len(pending)} usage events")
+
+    async def run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Recording usage events failed: {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Not cancelled, a flush in progress has to commit or restore its events
+        if self._task is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+async def rollup_usage_events(stopping: asyncio.Event = None) -> int:
+    """
+    Add the usage events recorded since the last rollup to the hour and day buckets, returns their number.
+
+    Events are aggregated in id order, in chunks of USAGE_ROLLUP_CHUNK_SIZE that each commit the buckets
+    together with the id of the last aggregated event. Events younger than USAGE_ROLLUP_DELAY seconds are
+    left for the next rollup, as inserts of other workers with lower ids may not be committed yet. Several
+    workers can roll up concurrently, only one of them advances the last event id.
+    """
+    aggregated = 0
+    while not (stopping and stopping.is_set()):
+        async with SessionLocal() as db:
+            last_event_id = await db.scalar(select(models.UsageRollup.last_event_id).where(models.UsageRollup.id == 1))
+            if last_event_id is None:
+                await db.execute(dialect_insert(db, models.UsageRollup).values(id=1, last_event_id=0).on_conflict_do_nothing())
+                await db.commit()
+                continue
+
+            events = (await db.execute(
+                select(models.UsageEvent.id, models.UsageEvent.created_at, models.UsageEvent.amount,
+                       models.UsageEvent.user_id, models.UsageEvent.course_id, models.UsageEvent.feature,
+                       models.UsageEvent.type)
+                .where(models.UsageEvent.id > last_event_id)
+                .order_by(models.UsageEvent.id)
+                .limit(USAGE_ROLLUP_CHUNK_SIZE)
+            )).all()
+
+            cutoff = utcnow() - timedelta(seconds=USAGE_ROLLUP_DELAY)
+            buckets = {}
+            event_id = last_event_id
+            chunk_events = 0
+            for event in events:
+                if event.created_at > cutoff:
+                    break
+                event_id = event.id
+                chunk_events += 1
+                for granularity in schemas.UsageGranularity:
+                    key = (granularity, bucket_start(event.created_at, granularity), event.user_id, event.course_id,
+                           event.feature, event.type)
+                    amount, count = buckets.get(key, (0, 0))
+                    buckets[key] = (amount + event.amount, count + 1)
+            if not buckets:
+                break
+
+            stmt = dialect_insert(db, models.UsageBucket)
+            await db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=models.USAGE_BUCKET_KEY,
+                    set_={
+                        "amount": models.UsageBucket.amount + stmt.excluded.amount,
+                        "events": models.UsageBucket.events + stmt.excluded.events
+                    }
+                ),
+                [
+                    {"granularity": granularity, "start": start, "user_id": user_id, "course_id": course_id,
+                     "feature": feature, "type": type, "amount": amount, "events": count}
+                    for (granularity, start, user_id, course_id, feature, type), (amount, count) in buckets.items()
+                ]
+            )
+            result = await db.execute(
+                update(models.UsageRollup)
+                .where(models.UsageRollup.id == 1, models.UsageRollup.last_event_id == last_event_id)
+                .values(last_event_id=event_id)
+            )
+            if result.rowcount != 1:
+                # Another worker aggregated the same events
+                await db.rollback()
+                break
+            await db.commit()
+
+        aggregated += chunk_events
+        if chunk_events < USAGE_ROLLUP_CHUNK_SIZE:
+            break
+        # Let requests waiting for the write lock in between
+        await asyncio.sleep(0)
+
+    if aggregated:
+        logging.info(f"Aggregated {aggregated} usage events")
+    return aggregated
+
+
+async def run_usage_rollup(stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=USAGE_ROLLUP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await rollup_usage_events(stopping)
+        except Exception as e:
+            logging.error(f"Aggregating usage events failed: {e}")
+
+
+usage_events = UsageEventLog(
+    enabled=os.getenv("USAGE_EVENTS", "true").lower() == "true",
+    flush_interval=float(os.getenv("USAGE_EVENTS_FLUSH_INTERVAL", "1.0")),
+    flush_threshold=int(os.getenv("USAGE_EVENTS_FLUSH_THRESHOLD", "1000"))
+)
@@ -1,11 +1,15 @@
+import functools
+import hashlib
+import time
+from collections import OrderedDict
 from fastapi import HTTPException, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from jose import JWTError, jwt
 import logging
 import os
 from dotenv import load_dotenv
 from pydantic import ValidationError
 
+from metrics import timed
 from schemas import JWTPayload
 
 load_dotenv()
@@ -13,24 +17,73 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 API_KEY = os.getenv("API_KEY")
 SUPPORTED_ALGORITHMS = list(os.getenv("SUPPORTED_ALGORITHMS", "").split(','))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
+@functools.cache
+def load_verification_keys() -> dict:
+    """
+    Construct the verification key of every supported algorithm once, on startup of the service.
+
+    HMAC algorithms use SECRET_KEY, asymmetric algorithms the PEM public key read from
+    <ALGORITHM>_PUBLIC_KEY_FILE, e.g. RS256_PUBLIC_KEY_FILE. Algorithms without a key are not accepted.
+    """
+    # jose loads its crypto backends on import, which would slow down every worker start
+    from jose import jwk
+
+    keys = {}
+    for algorithm in SUPPORTED_ALGORITHMS:
+        algorithm = algorithm.strip()
+        if algorithm.startswith("HS"):
+            key_data = SECRET_KEY
+        else:
+            key_file = os.getenv(f"{algorithm}_PUBLIC_KEY_FILE")
+            if not key_file:
+                logging.warning("No %s_PUBLIC_KEY_FILE configured, tokens signed with %s are rejected", algorithm, algorithm)
+                continue
+            with open(key_file) as f:
+                key_data = f.read()
+        keys[algorithm] = jwk.construct(key_data, algorithm)
+    return keys
+
+
+# Digests of verified tokens and their payloads, an entry is valid until the token expires
+verified_tokens: OrderedDict[bytes, JWTPayload] = OrderedDict()
+
+
+@timed("auth")
 def verify_token(token: str) -> JWTPayload:
+    from jose import JWTError, jwt
+
     credentials_exception = HTTPException(
         status_code=403, detail="Could not validate credentials"
     )
-    required_fields = {"sub", "name", "iat", "exp", "context-role"}
+
+    # Platforms re-send the same token, which was already verified
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = verified_tokens.get(digest)
+    if payload is not None:
+        if payload.exp > time.time():
+            verified_tokens.move_to_end(digest)
+            return payload
+        # Expired, the full verification rejects it below
+        del verified_tokens[digest]
 
     try:
         # Decode the JWT header
         header = jwt.get_unverified_header(token)
-        logging.debug(f"JWT header: {header}")
+        logging.debug("JWT header: %s", header)
 
-        # Decode the JWT payload#
-        payload = jwt.decode(token, SECRET_KEY, algorithms=SUPPORTED_ALGORITHMS)
-        logging.debug(f"Decoded payload: {payload}")
+        key = load_verification_keys().get(header.get("alg"))
+        if key is None:
+            logging.error("JWT validation error: Unsupported algorithm %s", header.get("alg"))
+            raise credentials_exception
+
+        # Decode the JWT payload
+        payload = jwt.decode(token, key, algorithms=[header["alg"]])
+        logging.debug("Decoded payload: %s", payload)
 
         # Validate required fields
         try:
@@ -44,15 +97,33 @@ def verify_token(token: str) -> JWTPayload:
             logging.error(f"Token validation failed: Token expiry exceeds limit")
             raise credentials_exception
 
-        logging.debug(f"Token validation successful for user: {payload.sub}")
+        verified_tokens[digest] = payload
+        if len(verified_tokens) > TOKEN_CACHE_SIZE:
+            verified_tokens.popitem(last=False)
+
+        logging.debug("Token validation successful for user: %s", payload.sub)
         return payload
     except JWTError as e:
         logging.error(f"JWT validation error: {e}")
         raise credentials_exception
 
 
+@timed("auth")
 def verify_api_key(authorization: HTTPAuthorizationCredentials = Security(HTTPBearer(scheme_name="API Key"))):
     if not authorization:
         raise HTTPException(status_code=403, detail="Missing API Key")
     if authorization.scheme != 'Bearer' or authorization.credentials != API_KEY:
         raise HTTPException(status_code=403, detail="Invalid API Key")
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so a W/ prefix does not matter
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))